@@ -0,0 +1,216 @@
+"""Benchmark cases of smartsql.
+
+Each case is a function, which prepares data and returns a callable without arguments, which is timed.
+"""
+from functools import reduce
+import operator
+
+from sqlbuilder.smartsql import Q, T, Insert, Param, Value, compile
+from sqlbuilder.smartsql.dialects.cassandra import compile as cassandra_compile
+from sqlbuilder.smartsql.dialects.mysql import compile as mysql_compile
+from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+
+__all__ = ('cases', 'case',)
+
+cases = []
+
+
+def case(group):
+    def deco(f):
+        f.name = "{0}.{1}".format(group, f.__name__)
+        cases.append(f)
+        return f
+    return deco
+
+
+def typical_query():
+    a, b = T.author, T.book
+    return Q().fields(
+        b.id, b.title, a.name.as_('author_name')
+    ).tables(
+        (b & a).on(b.author_id == a.id)
+    ).where(
+        (a.status == 'active') & (b.pub_date > '2015-01-01') & b.genre_id.in_([1, 2, 3])
+    ).order_by(
+        b.title, b.id.desc()
+    ).limit(10)
+
+
+@case('build')
+def field_comparison():
+    return lambda: T.author.name == 'Tom'
+
+
+@case('build')
+def and_chain():
+    fields = [getattr(T.book, 'f{0}'.format(i)) for i in range(20)]
+
+    def run():
+        reduce(operator.and_, [f == i for i, f in enumerate(fields)])
+    return run
+
+
+@case('build')
+def typical_select():
+    return typical_query
+
+
+@case('clone')
+def select_chain():
+    a, b = T.author, T.book
+
+    def run():
+        (Q().tables((b & a).on(b.author_id == a.id)).fields(b.id).fields(b.title).fields(a.name)
+         .where(a.status == 'active').where(b.pub_date > '2015').where(b.x > 1)
+         .order_by(b.title).order_by(b.id).group_by(b.id).having(b.x > 2)
+         .limit(10).distinct(True).fields(b.y).where(b.z < 3))
+    return run
+
+
+@case('clone')
+def select_clone():
+    return typical_query().clone
+
+
+@case('compile')
+def select():
+    q = typical_query()
+    return lambda: compile(q)
+
+
+@case('compile')
+def simple_select():
+    q = Q(T.author).fields('*').where(T.author.id == 1)
+    return lambda: compile(q)
+
+
+@case('compile')
+def distinct_values():
+    queries = [typical_query().where(T.book.x == i) for i in range(100, 200)]
+
+    def run():
+        for q in queries:
+            compile(q)
+    return run
+
+
+@case('compile')
+def deep_and_or():
+    f = T.book.id
+    expr = reduce(lambda e, i: (e & (f == i)) | (f > i), range(1, 1000), f == 0)
+    return lambda: compile(expr)
+
+
+@case('compile')
+def large_in():
+    expr = T.book.id.in_(list(range(10000)))
+    return lambda: compile(expr)
+
+
+@case('compile')
+def multirow_insert():
+    rows = [(i, 'title {0}'.format(i), i * 0.5) for i in range(10000)]
+    q = Insert(table=T.book, fields=(T.book.id, T.book.title, T.book.price), values=rows)
+    return lambda: compile(q)
+
+
+@case('compile')
+def columnar_insert():
+    columns = {'id': list(range(10000)), 'price': [i * 0.5 for i in range(10000)]}
+    q = Insert(table=T.book, columns=columns)
+    return lambda: compile(q)
+
+
+@case('compile')
+def nested_subqueries():
+    q = Q(T.book).fields(T.book.id).where(T.book.price > Param('price'))
+    for i in range(50):
+        q = Q(T.book).fields(T.book.id).where(T.book.id.in_(q) & (T.book.x == i))
+    return lambda: compile(q)
+
+
+@case('compile')
+def set_union():
+    q = reduce(operator.or_, [Q(T.book).fields(T.book.id).where(T.book.x == i) for i in range(200)])
+    return lambda: compile(q)
+
+
+@case('template_cache')
+def select_hit():
+    cache = compile.create_child().template_cache
+    q = typical_query()
+    cache(q)
+    return lambda: cache(q)
+
+
+@case('template_cache')
+def simple_select_hit():
+    cache = compile.create_child().template_cache
+    q = Q(T.author).fields('*').where(T.author.id == 1)
+    cache(q)
+    return lambda: cache(q)
+
+
+@case('template_cache')
+def distinct_values_hit():
+    """Queries of the same structure with different values, compare with compile.distinct_values."""
+    cache = compile.create_child().template_cache
+    queries = [typical_query().where(T.book.x == i) for i in range(100, 200)]
+    cache(queries[0])
+
+    def run():
+        for q in queries:
+            cache(q)
+    return run
+
+
+@case('dialect')
+def postgres():
+    q = typical_query()
+    return lambda: compile(q)
+
+
+@case('dialect')
+def mysql():
+    q = typical_query()
+    return lambda: mysql_compile(q)
+
+
+@case('dialect')
+def sqlite():
+    q = typical_query()
+    return lambda: sqlite_compile(q)
+
+
+@case('dialect')
+def cassandra():
+    q = Q(T.book).fields(T.book.id, T.book.title).where((T.book.author_id == 1) & (T.book.pub_date > '2015-01-01')).limit(10)
+    return lambda: cassandra_compile(q)
+
+
+def literals_query():
+    """Query with literals, which need escaping: quotes, backslashes, newlines and percent signs.
+
+    Short literals are cached by ValueCompiler, long ones are escaped on each compiling.
+    """
+    short = ["it's", 'C:\\temp', 'a\nb', '100%', 'plain']
+    long = [(value + ' ') * 20 for value in short]
+    return Q(T.book).fields(T.book.id).where(reduce(operator.and_, (
+        T.book.title != Value(value) for value in short + long
+    )))
+
+
+def escape_case(group, dialect_compile):
+    @case(group)
+    def escape():
+        q = literals_query()
+        return lambda: dialect_compile(q)
+    return escape
+
+
+for group, dialect_compile in (
+        ('dialect.postgres', compile),
+        ('dialect.mysql', mysql_compile),
+        ('dialect.sqlite', sqlite_compile),
+        ('dialect.cassandra', cassandra_compile)):
+    escape_case(group, dialect_compile)
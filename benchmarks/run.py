@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Runs benchmarks of smartsql and compares results with a baseline.
+
+Usage::
+
+    python benchmarks/run.py                               # run all cases
+    python benchmarks/run.py compile dialect.mysql         # run cases with given name prefixes
+    python benchmarks/run.py --output results.json         # write machine-readable results
+    python benchmarks/run.py --save-baseline               # store results as baseline
+    python benchmarks/run.py --threshold 0.2               # fail if a case is 20% slower than baseline
+
+Results are stored in JSON as ``{"cases": {name: {"min": seconds, "median": seconds, ...}}, ...}``.
+Time is the minimal time of one call among all repeats, so it's less sensitive to the noise.
+Exit code is 1 if any case regressed more than the threshold.
+Baseline depends on machine, so it's not committed; without baseline the comparison is skipped.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # run from source tree without installation
+sys.path.insert(0, ROOT)
+
+from cases import cases  # noqa
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def autorange(timer, min_time=0.2):
+    """Returns number of calls, which takes at least min_time."""
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            return number
+        number *= 2
+
+
+def measure(case, repeat=5, min_time=0.2):
+    timer = timeit.Timer(case())
+    number = autorange(timer, min_time)
+    times = sorted(t / number for t in timer.repeat(repeat, number))
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(names=(), repeat=5, min_time=0.2, verbose=True):
+    results = {}
+    for case in cases:
+        if names and not any(case.name == name or case.name.startswith(name + '.') for name in names):
+            continue
+        results[case.name] = measure(case, repeat, min_time)
+        if verbose:
+            print("{0:<32} {1:>12.3f} us".format(case.name, results[case.name]['min'] * 1e6))
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cases': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns list of (name, current, baseline, ratio) for cases slower than baseline more than threshold."""
+    regressions = []
+    for name, result in sorted(results['cases'].items()):
+        if name not in baseline['cases']:
+            continue
+        ratio = result['min'] / baseline['cases'][name]['min']
+        if ratio > 1 + threshold:
+            regressions.append((name, result['min'], baseline['cases'][name]['min'], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*', help="run only cases with given names or name prefixes, e.g. compile")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help="minimal time of one repeat in seconds")
+    parser.add_argument('--output', help="write results to the JSON file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="write results to the baseline file")
+    parser.add_argument('--threshold', type=float, default=0.1, help="allowed slowdown ratio, 0.1 means 10%%")
+    args = parser.parse_args(argv)
+
+    results = run(args.names, args.repeat, args.min_time)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline {0}, comparison is skipped. Use --save-baseline to create it.".format(args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for name, current, base, ratio in regressions:
+        print("REGRESSION {0}: {1:.3f} us, baseline {2:.3f} us ({3:+.1%})".format(
+            name, current * 1e6, base * 1e6, ratio - 1
+        ))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Measures throughput of compiling by concurrent threads.
+
+Usage::
+
+    python benchmarks/threads.py                          # 1, 2, 4 and 8 threads
+    python benchmarks/threads.py --threads 1 16 --duration 2
+    python benchmarks/threads.py --register               # register handlers while threads compile
+    python benchmarks/threads.py --output threads.json
+
+Throughput scales with count of threads only on free-threaded builds of CPython (3.13t+),
+with GIL it's expected to stay flat. Compiled SQL is verified, so the benchmark also detects data races.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # run from source tree without installation
+sys.path.insert(0, ROOT)
+
+from sqlbuilder.smartsql import compile  # noqa
+from cases import typical_query  # noqa
+
+
+def gil_enabled():
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+
+def worker(compiler, query, expected, stop, counts, errors, index):
+    count = 0
+    try:
+        while not stop.is_set():
+            for i in range(100):
+                if compiler(query) != expected:
+                    raise AssertionError("Unexpected result of compiling")
+            count += 100
+    except Exception as e:
+        errors.append(e)
+    counts[index] = count
+
+
+def registrar(compiler, stop):
+    """Registers handlers (the same ones) and precedences in a loop, each call replaces registry of compiler."""
+    from sqlbuilder.smartsql import Field, Add
+    handler = compiler.get_handler(Field)
+    while not stop.is_set():
+        compiler.when(Field)(handler)
+        compiler.set_precedence(210, Add)
+        time.sleep(0.001)
+
+
+def measure(threads, duration=1.0, register=False):
+    compiler = compile.create_child()
+    query = typical_query()
+    expected = compile(query)
+    stop = threading.Event()
+    counts = [0] * threads
+    errors = []
+    workers = [
+        threading.Thread(target=worker, args=(compiler, query, expected, stop, counts, errors, i))
+        for i in range(threads)
+    ]
+    if register:
+        workers.append(threading.Thread(target=registrar, args=(compiler, stop)))
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return sum(counts) / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--duration', type=float, default=1.0, help="duration of each measurement in seconds")
+    parser.add_argument('--register', action='store_true', help="register handlers while compiling")
+    parser.add_argument('--output', help="write results to the JSON file")
+    args = parser.parse_args(argv)
+
+    print("Python {0} ({1}), GIL {2}".format(
+        platform.python_version(), platform.python_implementation(), 'enabled' if gil_enabled() else 'disabled'
+    ))
+    results = {}
+    base = None
+    for threads in args.threads:
+        throughput = measure(threads, args.duration, args.register)
+        base = base or throughput
+        results[threads] = throughput
+        print("{0:>3} threads {1:>12.0f} compiles/s {2:>6.2f}x".format(threads, throughput, throughput / base))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'gil': gil_enabled(),
+                'throughput': dict((str(k), v) for k, v in results.items()),
+            }, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,4 @@
 from ...smartsql.dialects.sqlite import compile as parent_compile
 
 compile = parent_compile.create_child()
-
-
-@compile.when(object)
-def compile_object(compile, expr, state):
-    state.sql.append('%s')
-    state.params.append(expr)
+compile.paramstyle = 'format'  # Django converts it to qmark itself.
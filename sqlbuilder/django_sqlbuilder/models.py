@@ -4,6 +4,7 @@ import collections
 from django.conf import settings
 from django.db import connections
 from django.db.models import Model
+from django.db.models.sql.query import RawQuery
 
 from .. import smartsql
 from ..smartsql.dialects import mysql
@@ -39,6 +40,47 @@ class classproperty(object):
         return self.getter(owner)
 
 
+class ChunkedRawQuery(RawQuery):
+    """RawQuery, which fetches rows by chunks of given size, by server-side cursor, if it's supported."""
+
+    def __init__(self, sql, using, params=None, chunk_size=100):
+        super(ChunkedRawQuery, self).__init__(sql, using, params)
+        self.chunk_size = chunk_size
+
+    def clone(self, using):
+        return self.__class__(self.sql, using, self.params, self.chunk_size)
+
+    def _execute_query(self):
+        connection = connections[self.using]
+        self.cursor = getattr(connection, 'chunked_cursor', connection.cursor)()
+        self.cursor.execute(self.sql, self._adapt_params(connection))
+
+    def _adapt_params(self, connection):
+        # Like RawQuery._execute_query(), adapts params to the database, since the target type isn't known.
+        adapter = getattr(connection.ops, 'adapt_unknown_value', None)
+        if adapter is None or self.params is None:
+            return self.params
+        if isinstance(self.params, dict):
+            return dict((key, adapter(val)) for key, val in self.params.items())
+        return tuple(adapter(val) for val in self.params)
+
+    def __iter__(self):
+        # Query is executed at once, RawQuerySet reads description of columns before iteration.
+        self._execute_query()
+        return self._iterate(self.cursor)
+
+    def _iterate(self, cursor):
+        try:
+            while True:
+                rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+
 class Result(smartsql.Result):
 
     _cache = None
@@ -77,9 +119,14 @@ class Result(smartsql.Result):
         return self
 
     def count(self):
+        """Returns count of rows, without filling of cache."""
         if self._cache is not None:
             return len(self._cache)
-        return self.execute().fetchone()[0]
+        cursor = self.execute()
+        try:
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
 
     def clone(self):
         c = smartsql.Result.clone(self)
@@ -101,8 +148,21 @@ class Result(smartsql.Result):
         if self._cache is None:
             self._cache = list(self.iterator())
 
-    def iterator(self):
-        return self._model.objects.raw(*self.compile(self._query)).using(self._using)
+    def iterator(self, chunk_size=None, rows=False):
+        """Returns RawQuerySet, or iterator of model instances (or rows), fetched by chunks without caching.
+
+        :param chunk_size: Count of rows, which are fetched at once.
+        :param rows: Yield rows as tuples instead of model instances.
+        """
+        raw = self._model.objects.raw(*self.compile(self._query)).using(self._using)
+        if chunk_size is None:
+            return raw
+        raw.query = ChunkedRawQuery(raw.query.sql, self._using, raw.query.params, chunk_size)
+        if rows:
+            return iter(raw.query)
+        if hasattr(raw, 'iterator'):
+            return raw.iterator()  # Django 2.1+, iteration of RawQuerySet fills its cache.
+        return iter(raw)
 
 
 @factory.register
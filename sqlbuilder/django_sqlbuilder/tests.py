@@ -1,4 +1,5 @@
 from __future__ import absolute_import, unicode_literals
+import datetime
 from django.conf import settings
 from django.db import models
 from django.test import TestCase, override_settings
@@ -73,6 +74,23 @@ class TestDjangoSqlbuilder(TestCase):
         book2 = q[0]
         self.assertEqual(book2.id, book.id)
 
+    def test_iterator(self):
+        author = Author.objects.create(first_name='John', last_name='Smith')
+        for i in range(5):
+            Book.objects.create(title="Title {0}".format(i), author_id=author.id)
+        q = Book.s.q.order_by(Book.s.pk)
+        books = list(q.iterator(chunk_size=2))
+        self.assertEqual([b.title for b in books], ["Title {0}".format(i) for i in range(5)])
+        self.assertIsInstance(books[0], Book)
+        rows = list(q.fields(Book.s.title, reset=True).iterator(chunk_size=2, rows=True))
+        self.assertEqual(rows, [("Title {0}".format(i),) for i in range(5)])
+        self.assertIsNone(q.result._cache)
+        self.assertEqual(q.count(), 5)
+        self.assertIsNone(q.result._cache)
+        # Params are adapted to the database, like by RawQuerySet, sqlite3 can't bind datetime.time.
+        q = Book.s.q.where(Book.s.title != datetime.time(12, 30)).order_by(Book.s.pk)
+        self.assertEqual(len(list(q.iterator(chunk_size=2))), 5)
+
     def _create_objects(self):
         author = Author.objects.create(first_name='John', last_name='Smith')
         book = Book.objects.create(title="Title 1", author_id=author.id)
@@ -3,13 +3,20 @@
 # Pay attention also to excellent lightweight SQLBuilder
 # of Storm ORM http://bazaar.launchpad.net/~storm/storm/trunk/view/head:/storm/expr.py
 from __future__ import absolute_import
+import re
 import sys
 import copy
+import time
+import hashlib
+import binascii
 import types
 import weakref
 import operator
 import warnings
+import itertools
+import threading
 import collections
+from contextlib import contextmanager
 from functools import wraps, reduce
 
 try:
@@ -23,15 +30,20 @@ except NameError:
 
 
 DEFAULT_DIALECT = 'postgres'
-PLACEHOLDER = "%s"  # Can be re-defined by registered dialect.
+PLACEHOLDER = "%s"  # Placeholder of paramstyle "format", see Compiler.paramstyle
 LOOKUP_SEP = '__'
 MAX_PRECEDENCE = 1000
 SPACE = " "
+SQL_DEPENDENT = object()  # Marker of precedence table, precedence depends on expr.sql
 
 CONTEXT_QUERY = 0
 CONTEXT_COLUMN = 1
 CONTEXT_TABLE = 2
 
+LEAF_TYPES = integer_types + string_types + (float, bool, bytes, type(None))
+
+default_timer = getattr(time, 'perf_counter', time.time)
+
 
 def same(name):
     def f(self, *a, **kw):
@@ -39,6 +51,33 @@ def same(name):
     return f
 
 
+_slot_descriptors = {}
+
+
+def copy_instance(obj):
+    """Returns shallow copy of object, like copy.copy(), but faster, and without calling of obj.__copy__()."""
+    cls = obj.__class__
+    c = cls.__new__(cls)
+    try:
+        descriptors = _slot_descriptors[cls]
+    except KeyError:
+        descriptors = []
+        for klass in cls.__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, string_types):
+                slots = (slots,)
+            descriptors.extend(klass.__dict__[name] for name in slots if name not in ('__dict__', '__weakref__'))
+        _slot_descriptors[cls] = descriptors
+    for descriptor in descriptors:
+        try:
+            descriptor.__set__(c, descriptor.__get__(obj, cls))
+        except AttributeError:
+            pass
+    if hasattr(c, '__dict__'):
+        c.__dict__.update(obj.__dict__)
+    return c
+
+
 class Factory(object):
 
     def register(self, name_or_callable):
@@ -63,27 +102,81 @@ class Factory(object):
         except AttributeError:
             return cls.default()
 
+    _lock = threading.Lock()
+
     @staticmethod
     def default():
         cls = Factory
-        if not hasattr(cls, '_default'):
-            cls._default = cls()
-        return cls._default
+        try:
+            return cls._default
+        except AttributeError:
+            with cls._lock:
+                if not hasattr(cls, '_default'):
+                    cls._default = cls()
+            return cls._default
 
 factory = Factory.default()
 
 
+class Error(Exception):
+    pass
+
+
+class CallerStack(list):
+    """Stack of callers, it grows from the end, but is indexed from the top.
+
+    So, callers[0] is the class of current expression, and callers[1] is the class of its caller.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return list(reversed(self))[key]
+        return list.__getitem__(self, -1 - key)
+
+    def __getslice__(self, i, j):  # Python 2.* compatible, list.__getslice__() takes precedence over __getitem__()
+        return self.__getitem__(slice(i, j))
+
+    def __iter__(self):
+        return reversed(self)
+
+
 class State(object):
 
+    __slots__ = (
+        'sql', 'params', '_stack', 'callers', 'auto_tables', 'join_tables', 'context', 'precedence',
+        'writer', 'params_writer', 'param_offset', 'paramstyle'
+    )
+
+    buffer_size = 4096  # Min count of SQL fragments, which are passed to writer at once.
+
     def __init__(self):
         self.sql = []
         self.params = []
         self._stack = []
-        self.callers = []
+        self.callers = CallerStack()
         self.auto_tables = []
         self.join_tables = []
         self.context = CONTEXT_QUERY
         self.precedence = 0
+        self.writer = None
+        self.params_writer = None
+        self.param_offset = 0  # Count of params, passed to params_writer, for numbering of placeholders.
+        self.paramstyle = None  # ParamStyle of the registry snapshot, it's set by compiler for the whole compiling.
+
+    def flush(self, force=False):
+        """Passes collected SQL to writer.write() and params to params_writer(), if writer is set.
+
+        Handlers can call it between parts of statement, but it works only for top-level statement,
+        because handlers of outer expressions can change collected SQL and params.
+        """
+        if self.writer is not None and len(self.callers) <= 1 and (force or len(self.sql) >= self.buffer_size):
+            self.writer.write(''.join(self.sql))
+            del self.sql[:]
+            self.params_writer(self.params)
+            self.param_offset += len(self.params)
+            del self.params[:]
 
     def push(self, attr, new_value=None):
         old_value = getattr(self, attr, None)
@@ -94,103 +187,674 @@ class State(object):
         return old_value
 
     def pop(self):
-        setattr(self, *self._stack.pop(-1))
+        attr, old_value = self._stack.pop()
+        setattr(self, attr, old_value)
+
+
+class ParamStyle(object):
+    """Placeholder and escaping of paramstyle, see Compiler.paramstyle. It's published as part of Registry."""
+
+    __slots__ = ('name', 'placeholder_template', 'placeholder', 'named', 'escape_percent')
+
+    def __init__(self, name, placeholder_template, named=False, escape_percent=False):
+        self.name = name
+        self.placeholder_template = placeholder_template
+        self.placeholder = None if '{0}' in placeholder_template else placeholder_template  # None for numbered styles
+        self.named = named
+        self.escape_percent = escape_percent
+
+    def format_params(self, params, offset=0):
+        """Returns params in form of paramstyle, list or dict."""
+        if self.named:
+            return dict(('p{0}'.format(i), value) for i, value in enumerate(params, offset + 1))
+        return params
+
+
+class Registry(object):
+    """Snapshot of handlers, precedences and paramstyle of Compiler, it's replaced as a whole on each change.
+
+    Compiling threads read the current snapshot without locks. Lazy caches of snapshot are filled
+    only from its own registry, so a thread, which uses an old snapshot, can't spoil a new one.
+    The same is true for storage of TemplateCache, it's dropped together with the snapshot.
+    """
+
+    __slots__ = (
+        'handlers', 'precedence', 'profiler', 'paramstyle', 'cache_token', 'dispatch_cache', 'leaf_dispatch',
+        'plain_types', 'row_templates', 'precedence_table', 'template_layouts', 'templates', 'template_kinds',
+    )
+
+    def __init__(self, handlers, precedence, profiler=None, paramstyle=None):
+        self.handlers = handlers
+        self.precedence = precedence
+        self.profiler = profiler
+        self.paramstyle = paramstyle
+        self.cache_token = object()  # Version of fragments, cached by cached_compile().
+        self.dispatch_cache = {}
+        self.leaf_dispatch = {}
+        self.plain_types = {}
+        self.row_templates = {}
+        self.precedence_table = {}
+        self.template_layouts = collections.OrderedDict()  # structure => TemplateLayout
+        self.templates = collections.OrderedDict()  # (TemplateLayout, values of sql positions) => sql
+        self.template_kinds = {}
 
 
 class Compiler(object):
 
+    _precedence_table_size = 4096
+    _lock = threading.RLock()  # Serializes changes of registries of all compilers, compiling is lock-free.
+    max_params = 65535  # Max count of params in one statement, see InsertChunks.
+
+    # Placeholders of paramstyles of PEP 249, and of native style of PostgreSQL ("dollar").
+    paramstyles = {
+        'format': PLACEHOLDER,
+        'qmark': '?',
+        'numeric': ':{0}',
+        'dollar': '${0}',
+        'named': ':p{0}',
+        'pyformat': '%(p{0})s',
+    }
+    named_paramstyles = ('named', 'pyformat')  # Params are returned as dict.
+    percent_paramstyles = ('format', 'pyformat')  # Percent sign in SQL is escaped.
+
     def __init__(self, parent=None):
         self._children = weakref.WeakKeyDictionary()
         self._parents = []
         self._local_registry = {}
         self._local_precedence = {}
-        self._registry = {}
-        self._precedence = {}
+        self._paramstyle = self._get_paramstyle(parent.paramstyle if parent else 'format')
+        self._registry = Registry({}, {}, None, self._paramstyle)
+        self._template_cache = None
+        self._profiler = None
+        self._local_hooks = []
+        self._hooks = ()
         if parent:
-            self._parents.extend(parent._parents)
-            self._parents.append(parent)
-            parent._children[self] = True
-            self._update_cache()
+            with self._lock:
+                self.max_params = parent.max_params
+                self._parents.extend(parent._parents)
+                self._parents.append(parent)
+                parent._children[self] = True
+                self._update_cache()
+                self._update_hooks()
 
     def create_child(self):
         return self.__class__(self)
 
     def when(self, cls):
         def deco(func):
-            self._local_registry[cls] = func
-            self._update_cache()
+            with self._lock:
+                self._local_registry[cls] = func
+                self._update_cache()
             return func
         return deco
 
     def set_precedence(self, precedence, *types):
-        for type in types:
-            self._local_precedence[type] = precedence
-        self._update_cache()
+        with self._lock:
+            for type in types:
+                self._local_precedence[type] = precedence
+            self._update_cache()
 
     def _update_cache(self):
-        for parent in self._parents:
-            self._registry.update(parent._local_registry)
-            self._precedence.update(parent._local_precedence)
-        self._registry.update(self._local_registry)
-        self._precedence.update(self._local_precedence)
-        for child in self._children:
-            child._update_cache()
+        """Builds new snapshot of registry and publishes it by one assignment (copy-on-write)."""
+        with self._lock:
+            handlers = {}
+            precedence = {}
+            for compiler in self._parents + [self]:
+                handlers.update(compiler._local_registry)
+                precedence.update(compiler._local_precedence)
+            registry = Registry(handlers, precedence, self._get_profiler(), self._paramstyle)
+            for key in precedence:
+                if isinstance(key, type):
+                    registry.precedence_table[key] = self._get_class_precedence(key, registry)
+                elif isinstance(key, tuple):
+                    registry.precedence_table[key] = self._get_sql_precedence(key[0], key[1], registry)
+            for cls in LEAF_TYPES:
+                if cls not in precedence:
+                    try:
+                        registry.leaf_dispatch[cls] = self._resolve_handler(cls, registry)
+                    except Error:
+                        pass
+            self._registry = registry
+            for child in list(self._children.keys()):
+                child._update_cache()
+
+    @property
+    def paramstyle(self):
+        """Style of placeholders, one of Compiler.paramstyles.
+
+        Numbered styles are numbered during compiling, by position of param in State.
+        Params of named styles are returned as dict, with names p1, p2, ...
+        """
+        return self._paramstyle.name
+
+    @paramstyle.setter
+    def paramstyle(self, paramstyle):
+        paramstyle = self._get_paramstyle(paramstyle)
+        with self._lock:
+            # Placeholder and escaping are switched together, by publishing of a new snapshot of registry.
+            self._paramstyle = paramstyle
+            self._update_cache()
+
+    def _get_paramstyle(self, name):
+        try:
+            placeholder = self.paramstyles[name]
+        except KeyError:
+            raise Error("Unknown paramstyle {0!r}".format(name))
+        return ParamStyle(name, placeholder, name in self.named_paramstyles, name in self.percent_paramstyles)
+
+    @property
+    def template_cache(self):
+        if self._template_cache is None:
+            self._template_cache = TemplateCache(self)
+        return self._template_cache
+
+    def _resolve_handler(self, cls, registry=None):
+        registry = registry or self._registry
+        for c in cls.mro():
+            if c in registry.handlers:
+                if registry.profiler is not None:
+                    return registry.profiler.wrap(registry.handlers[c])
+                return registry.handlers[c]
+        raise Error("Unknown compiler for {0}".format(cls))
+
+    def _get_profiler(self):
+        for compiler in [self] + self._parents[::-1]:
+            if compiler._profiler is not None:
+                return compiler._profiler
+        return None
+
+    def add_hook(self, hook):
+        """Registers callable, which is called with CompileEvent after each top-level compiling.
+
+        Hooks are inherited by child compilers. Can be used as decorator.
+        """
+        with self._lock:
+            self._local_hooks.append(hook)
+            self._update_hooks()
+        return hook
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._local_hooks.remove(hook)
+            self._update_hooks()
+
+    def _update_hooks(self):
+        with self._lock:
+            hooks = []
+            for compiler in self._parents + [self]:
+                hooks.extend(compiler._local_hooks)
+            self._hooks = tuple(hooks)
+            for child in list(self._children.keys()):
+                child._update_hooks()
+
+    def _fire_hooks(self, expr, sql, params, start, sql_length=None):
+        event = CompileEvent(self, expr, sql, params, default_timer() - start, sql_length)
+        for hook in self._hooks:
+            hook(event)
+
+    @contextmanager
+    def profile(self, profiler=None):
+        """Collects statistics of handlers, while the context is active.
+
+        Handlers are wrapped only inside of the context, so profiling has no overhead when it's off.
+        Child compilers are profiled too, unless they have own profiler.
+
+            with compile.profile() as profiler:
+                compile(q)
+            print(profiler.report())
+        """
+        if profiler is None:
+            profiler = Profiler()
+        with self._lock:
+            previous = self._profiler
+            self._profiler = profiler
+            self._update_cache()
+        try:
+            yield profiler
+        finally:
+            with self._lock:
+                self._profiler = previous
+                self._update_cache()
+
+    def get_handler(self, cls):
+        return self._get_dispatch(cls)[0]
+
+    def is_plain(self, cls):
+        """Returns True, if instances of the class are passed to params as is, with placeholder in SQL."""
+        registry = self._registry
+        try:
+            return registry.plain_types[cls]
+        except KeyError:
+            plain = registry.plain_types[cls] = (
+                cls not in registry.precedence and
+                self._get_dispatch(cls, registry)[0] is self._get_dispatch(object, registry)[0]
+            )
+            return plain
+
+    def _get_row_template(self, nulls, state):
+        """Returns template of a row of plain values, or None if the row is not rendered as sequence of placeholders.
+
+        Template is SQL of the row, or tuple of parts of SQL between placeholders for numbered paramstyles,
+        see _render_rows().
+
+        :param nulls: Tuple of flags, which of values are None.
+        """
+        registry = self._registry
+        paramstyle = registry.paramstyle
+        if state.paramstyle is not paramstyle:
+            return None  # Paramstyle is being switched, templates of the snapshot are rendered for the new one.
+        row_templates = registry.row_templates
+        try:
+            return row_templates[nulls]
+        except KeyError:
+            pass
+        row = tuple(None if is_null else Param() for is_null in nulls)
+        markers = [marker for marker in row if marker is not None]
+        sql, params = self._compile(row, paramstyle)
+        if len(params) != len(markers) or not all(a is b for a, b in zip(params, markers)):
+            sql = None
+        elif paramstyle.placeholder is None:
+            # Placeholders are numbered from 1 here, they are renumbered by position of the row in statement.
+            parts = []
+            start = 0
+            try:
+                for i in range(1, len(markers) + 1):
+                    placeholder = paramstyle.placeholder_template.format(i)
+                    end = sql.index(placeholder, start)
+                    parts.append(sql[start:end])
+                    start = end + len(placeholder)
+            except ValueError:
+                sql = None
+            else:
+                parts.append(sql[start:])
+                sql = tuple(parts)
+        row_templates[nulls] = sql
+        return sql
+
+    @staticmethod
+    def _render_rows(template, state, count=1):
+        """Returns SQL of count rows by template of row, numbering of placeholders continues params of state."""
+        if not isinstance(template, tuple):
+            return template if count == 1 else ", ".join([template] * count)
+        placeholder_template = state.paramstyle.placeholder_template
+        number = state.param_offset + len(state.params)
+        sql = []
+        for i in range(count):
+            if i:
+                sql.append(", ")
+            sql.append(template[0])
+            for part in template[1:]:
+                number += 1
+                sql.append(placeholder_template.format(number))
+                sql.append(part)
+        return ''.join(sql)
+
+    def _get_dispatch(self, cls, registry=None):
+        registry = registry or self._registry
+        try:
+            return registry.dispatch_cache[cls]
+        except KeyError:
+            handler = self._resolve_handler(cls, registry)
+            dispatch = registry.dispatch_cache[cls] = (handler, getattr(handler, 'iterate', None))
+            return dispatch
 
     def __call__(self, expr, state=None):
         if state is None:
+            if self._hooks:
+                start = default_timer()
+                state = State()
+                self(expr, state)
+                sql, params = ''.join(state.sql), state.paramstyle.format_params(state.params)
+                self._fire_hooks(expr, sql, params, start)
+                return sql, params
             state = State()
             self(expr, state)
-            return ''.join(state.sql), state.params
+            return ''.join(state.sql), state.paramstyle.format_params(state.params)
+
+        # Non-recursive engine. Iterative handlers yield nested expressions instead of
+        # calling compile(expr, state), so depth of expression tree is not limited by the stack.
+        registry = self._registry  # One snapshot for the whole call, even if the compiler is changed meanwhile.
+        if state.paramstyle is None:
+            state.paramstyle = registry.paramstyle
+        leaf_dispatch = registry.leaf_dispatch
+        dispatch_cache = registry.dispatch_cache
+        precedence_table = registry.precedence_table
+        stack = []
+        while True:
+            cls = expr.__class__
+            # Fast path for plain params, they have no children and default precedence.
+            if cls in leaf_dispatch and state.precedence <= MAX_PRECEDENCE:
+                leaf_dispatch[cls](self, expr, state)
+            else:
+                outer_precedence = state.precedence
+                # Inlined fast path of self.get_inner_precedence(expr)
+                inner_precedence = precedence_table.get(cls, SQL_DEPENDENT)
+                if inner_precedence is SQL_DEPENDENT:
+                    try:
+                        inner_precedence = precedence_table[(cls, getattr(expr, 'sql', None))]
+                    except (KeyError, TypeError):
+                        inner_precedence = self.get_inner_precedence(expr, registry)
+                if inner_precedence is None:
+                    # pass current precedence
+                    # FieldList, ExprList, All, Distinct...?
+                    inner_precedence = outer_precedence
+                state.precedence = inner_precedence
+                parentheses = inner_precedence < outer_precedence
+                state.callers.append(cls)
+                if parentheses:
+                    state.sql.append('(')
 
-        cls = expr.__class__
-        parentheses = None
-        outer_precedence = state.precedence
-        inner_precedence = self.get_inner_precedence(expr)
-        if inner_precedence is None:
-            # pass current precedence
-            # FieldList, ExprList, All, Distinct...?
-            inner_precedence = outer_precedence
-        state.precedence = inner_precedence
-        if inner_precedence < outer_precedence:
-            parentheses = True
-
-        state.callers.insert(0, expr.__class__)
-
-        if parentheses:
-            state.sql.append('(')
+                try:
+                    handler, iterate = dispatch_cache[cls]
+                except KeyError:
+                    handler, iterate = self._get_dispatch(cls, registry)
+                if iterate is not None:
+                    stack.append((iterate(self, expr, state), parentheses, outer_precedence))
+                else:
+                    handler(self, expr, state)
+                    if parentheses:
+                        state.sql.append(')')
+                    state.callers.pop()
+                    state.precedence = outer_precedence
+
+            while stack:
+                frame = stack[-1]
+                expr = next(frame[0], frame)
+                if expr is not frame:
+                    break
+                stack.pop()
+                if frame[1]:
+                    state.sql.append(')')
+                state.callers.pop()
+                state.precedence = frame[2]
+            else:
+                return
 
-        for c in cls.mro():
-            if c in self._registry:
-                self._registry[c](self, expr, state)
-                break
+    def _compile(self, expr, paramstyle=None):
+        """Returns SQL and list of params, like __call__(), but without hooks and formatting of params.
+
+        :param paramstyle: ParamStyle of SQL, default is paramstyle of the current snapshot of registry.
+        """
+        state = State()
+        state.paramstyle = paramstyle
+        self(expr, state)
+        return ''.join(state.sql), state.params
+
+    def write(self, expr, writer, params=None):
+        """Compiles expression to writer, any object with write() method, like file.
+
+        Streaming statements (like Insert) are passed to the writer by parts, so memory usage is bounded.
+        Params are passed to params.extend() (or params.update() for named paramstyles) by the same parts.
+        Returns params, a new list (or dict) by default.
+        Hooks get only the head of written SQL (see SQLRecorder), to keep memory usage bounded.
+        """
+        start = default_timer()
+        if self._hooks:
+            writer = SQLRecorder(writer)
+        state = State()
+        state.writer = writer
+        state.paramstyle = paramstyle = self._registry.paramstyle
+        if paramstyle.named:
+            params = {} if params is None else params
+            state.params_writer = lambda values: params.update(paramstyle.format_params(values, state.param_offset))
         else:
-            raise Error("Unknown compiler for {0}".format(cls))
+            params = [] if params is None else params
+            state.params_writer = params.extend
+        self(expr, state)
+        state.flush(True)
+        if self._hooks:
+            self._fire_hooks(expr, writer.head, params, start, writer.length)
+        return params
+
+    def get_inner_precedence(self, cls_or_expr, registry=None):
+        registry = registry or self._registry
+        if isinstance(cls_or_expr, type):
+            return registry.precedence.get(cls_or_expr, MAX_PRECEDENCE)
 
-        if parentheses:
-            state.sql.append(')')
-        state.callers.pop(0)
-        state.precedence = outer_precedence
+        expr = cls_or_expr
+        cls = expr.__class__
+        table = registry.precedence_table
+        try:
+            precedence = table[cls]
+        except KeyError:
+            precedence = table[cls] = self._get_class_precedence(cls, registry)
+        if precedence is not SQL_DEPENDENT:
+            return precedence
+
+        sql = getattr(expr, 'sql', None)
+        if not isinstance(sql, string_types):
+            # For example, Alias.sql is a Name, own for each instance, it would flood the table and keep names alive.
+            return self._get_sql_precedence(cls, sql, registry)
+        try:
+            return table[(cls, sql)]
+        except KeyError:
+            precedence = self._get_sql_precedence(cls, sql, registry)
+            if len(table) < self._precedence_table_size:
+                table[(cls, sql)] = precedence
+            return precedence
+
+    def _get_class_precedence(self, cls, registry):
+        if issubclass(cls, Expr):
+            return SQL_DEPENDENT
+        return registry.precedence.get(cls, MAX_PRECEDENCE)
+
+    def _get_sql_precedence(self, cls, sql, registry):
+        precedence = registry.precedence
+        if sql is not None:
+            try:
+                if (cls, sql) in precedence:
+                    return precedence[(cls, sql)]
+                elif sql in precedence:
+                    return precedence[sql]
+            except TypeError:
+                pass
+        return precedence.get(cls, MAX_PRECEDENCE)  # precedence.get('(any other)', MAX_PRECEDENCE)
+
+
+class CompileEvent(object):
+    """Event of top-level compiling, which is passed to hooks of compiler, see Compiler.add_hook()."""
+
+    __slots__ = ('compiler', 'expr', 'sql', 'params', 'duration', '_sql_length', '_fingerprint')
+
+    placeholder_list_re = re.compile(r'(%s|\?|\$\d+|:\w+|%\(\w+\)s)(, (%s|\?|\$\d+|:\w+|%\(\w+\)s))+')
+    row_list_re = re.compile(r'(\([^()]*\))(, \1)+')
+
+    def __init__(self, compiler, expr, sql, params, duration, sql_length=None):
+        self.compiler = compiler
+        self.expr = expr
+        self.sql = sql  # Can be only the head of SQL, which was passed to a writer, see Compiler.write().
+        self.params = params
+        self.duration = duration
+        self._sql_length = sql_length
+        self._fingerprint = None
 
-    def get_inner_precedence(self, cls_or_expr):
-        if isinstance(cls_or_expr, type):
-            cls = cls_or_expr
-            if cls in self._precedence:
-                return self._precedence[cls]
-        else:
-            expr = cls_or_expr
-            cls = expr.__class__
-            if issubclass(cls, Expr) and hasattr(expr, 'sql'):
+    @property
+    def statement(self):
+        """Type of statement: Select, Insert, Update, Delete, Set, Raw, Copy, or class name of expression."""
+        return get_statement_type(self.expr.__class__)
+
+    @property
+    def sql_length(self):
+        return len(self.sql) if self._sql_length is None else self._sql_length
+
+    @property
+    def param_count(self):
+        return len(self.params)
+
+    @property
+    def normalized_sql(self):
+        """SQL, where lists of placeholders (like IN) and of equal rows (like VALUES) are shortened."""
+        return self.row_list_re.sub(r'\1, ...', self.placeholder_list_re.sub(r'\1, ...', self.sql))
+
+    @property
+    def fingerprint(self):
+        """Hash of normalized SQL, it's the same for queries which differ only by values or count of params in lists."""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(self.normalized_sql.encode('utf-8')).hexdigest()[:16]
+        return self._fingerprint
+
+
+class SQLRecorder(object):
+    """Proxy of writer, which keeps the head of written SQL and its length for hooks.
+
+    Parts are kept whole (they are split between rows), until the head exceeds max_head,
+    so normalized SQL of the head is the same for statements of the same structure.
+    """
+
+    max_head = 65536
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.head = ''
+        self.length = 0
+
+    def write(self, sql):
+        self.writer.write(sql)
+        if len(self.head) < self.max_head:
+            self.head += sql
+        self.length += len(sql)
+
+
+_statement_types = {}
+
+
+def get_statement_type(cls):
+    try:
+        return _statement_types[cls]
+    except KeyError:
+        pass
+    for base, name in ((Raw, 'Raw'), (Set, 'Set'), (Select, 'Select'), (Insert, 'Insert'),
+                       (Update, 'Update'), (Delete, 'Delete'), (Copy, 'Copy')):
+        if issubclass(cls, base):
+            break
+    else:
+        name = cls.__name__
+    _statement_types[cls] = name
+    return name
+
+
+class ProfileStats(object):
+
+    __slots__ = ('name', 'calls', 'cumtime', 'selftime', 'fragments')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.cumtime = 0.0  # Recursive calls are counted only once, like in cProfile.
+        self.selftime = 0.0
+        self.fragments = 0  # SQL fragments in the result of handler (with nested handlers), like cumtime.
+
+    def __repr__(self):
+        return "<ProfileStats {0}: calls={1}, cumtime={2:.6f}, selftime={3:.6f}, fragments={4}>".format(
+            self.name, self.calls, self.cumtime, self.selftime, self.fragments
+        )
+
+
+class Profiler(object):
+    """Statistics of compiler handlers, see Compiler.profile().
+
+    Fragments are counted by length of state.sql, so they are not exact for streaming by Compiler.write().
+    """
+
+    timer = default_timer
+
+    def __init__(self):
+        self._wrappers = {}
+        self._local = threading.local()
+        self.stats = {}
+        self.max_depth = 0
+
+    def reset(self):
+        self.stats = {}
+        self.max_depth = 0
+
+    def wrap(self, handler):
+        try:
+            return self._wrappers[handler]
+        except KeyError:
+            pass
+        origin = handler
+        while hasattr(origin, '__wrapped__'):
+            origin = origin.__wrapped__
+        name = getattr(origin, '__name__', origin.__class__.__name__)
+        module = getattr(origin, '__module__', __name__)
+        if module != __name__:
+            name = "{0}.{1}".format(module.rsplit('.', 1)[-1], name)
+        profiler = self
+
+        def wrapped(compile, expr, state):
+            entry = profiler._enter(name, state)
+            try:
+                handler(compile, expr, state)
+            finally:
+                profiler._exit(entry, state)
+
+        iterate = getattr(handler, 'iterate', None)
+        if iterate is not None:
+            def wrapped_iterate(compile, expr, state):
+                entry = profiler._enter(name, state)
                 try:
-                    if (cls, expr.sql) in self._precedence:
-                        return self._precedence[(cls, expr.sql)]
-                    elif expr.sql in self._precedence:
-                        return self._precedence[expr.sql]
-                except TypeError:
-                    # For case when expr.sql is unhashable, for example we can allow T('tablename').sql (in future).
-                    pass
-            return self.get_inner_precedence(cls)
+                    for child in iterate(compile, expr, state):
+                        yield child
+                finally:
+                    profiler._exit(entry, state)
+            wrapped.iterate = wrapped_iterate
+
+        self._wrappers[handler] = wrapped
+        return wrapped
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            self._local.active = collections.defaultdict(int)
+            return stack
 
-        return MAX_PRECEDENCE  # self._precedence.get('(any other)', MAX_PRECEDENCE)
+    def _enter(self, name, state):
+        stack = self._get_stack()
+        try:
+            stats = self.stats[name]
+        except KeyError:
+            stats = self.stats[name] = ProfileStats(name)
+        stats.calls += 1
+        self._local.active[name] += 1
+        # [stats, start time, time of nested handlers, start length of sql]
+        entry = [stats, self.timer(), 0.0, len(state.sql)]
+        stack.append(entry)
+        if len(stack) > self.max_depth:
+            self.max_depth = len(stack)
+        return entry
+
+    def _exit(self, entry, state):
+        elapsed = self.timer() - entry[1]
+        stack = self._get_stack()
+        # Entries of nested handlers can be left on stack in case of exception.
+        while stack and stack.pop() is not entry:
+            pass
+        stats = entry[0]
+        stats.selftime += elapsed - entry[2]
+        self._local.active[stats.name] -= 1
+        if not self._local.active[stats.name]:
+            stats.cumtime += elapsed
+            stats.fragments += len(state.sql) - entry[3]
+        if stack:
+            stack[-1][2] += elapsed
+
+    def get_stats(self, sort='cumtime'):
+        """Returns list of ProfileStats, sorted by given attribute in descending order."""
+        return sorted(self.stats.values(), key=operator.attrgetter(sort), reverse=(sort != 'name'))
+
+    def report(self, sort='cumtime', limit=None):
+        lines = ["{0:<40} {1:>10} {2:>12} {3:>12} {4:>10}".format(
+            'handler', 'calls', 'cumtime', 'selftime', 'fragments'
+        )]
+        for stats in self.get_stats(sort)[:limit]:
+            lines.append("{0:<40} {1:>10d} {2:>12.6f} {3:>12.6f} {4:>10d}".format(
+                stats.name, stats.calls, stats.cumtime, stats.selftime, stats.fragments
+            ))
+        lines.append("max depth: {0}".format(self.max_depth))
+        return "\n".join(lines)
 
 compile = Compiler()
 
@@ -207,23 +871,76 @@ def opt_checker(k_list):
     return new_deco
 
 
-def cached_compile(f):
+def iterative(f):
+    """Makes handler available for non-recursive compiling.
+
+    Decorated function should be a generator, that yields nested expressions
+    instead of calling compile(expr, state). The result still can be called as usual handler.
+    """
     @wraps(f)
     def deco(compile, expr, state):
-        if compile not in expr.__cached__:
-            state.push('sql', [])
+        for child in f(compile, expr, state):
+            compile(child, state)
+    deco.iterate = f
+    return deco
+
+
+def cached_compile(f):
+    """Caches the result of handler in expr.__cached__, so expression should be immutable.
+
+    The result is cached per compiler and per class of caller, since rendering can depend on caller.
+    Params and tables, added to state.auto_tables and state.join_tables, are cached too.
+    Each compiler has one entry per caller, it's replaced when registry of the compiler is changed.
+    """
+    def deco(compile, expr, state):
+        try:
+            caller = state.callers[1]
+        except IndexError:
+            caller = None
+        key = (id(compile), caller)
+        registry = compile._registry
+        if state.paramstyle is not registry.paramstyle:
+            f(compile, expr, state)  # Paramstyle is being switched, the fragment would be cached for wrong one.
+            return
+        token = registry.cache_token
+        try:
+            cache_token, sql, params, auto_tables, join_tables = expr.__cached__[key]
+            if cache_token is not token:
+                raise KeyError(key)
+        except KeyError:
+            sql, params, auto_tables, join_tables = state.sql, state.params, state.auto_tables, state.join_tables
+            start = len(sql), len(params), len(auto_tables), len(join_tables)
             f(compile, expr, state)
-            # TODO: also cache state.tables?
-            expr.__cached__[compile] = ''.join(state.sql)
-            state.pop()
-        state.sql.append(expr.__cached__[compile])
+            fragment = ''.join(sql[start[0]:])
+            del sql[start[0]:]
+            sql.append(fragment)
+            if state.paramstyle.placeholder is None and len(params) > start[1]:
+                return  # Numbered placeholders depend on position of expression.
+            expr.__cached__[key] = (
+                token, fragment, params[start[1]:], auto_tables[start[2]:], join_tables[start[3]:]
+            )
+        else:
+            state.sql.append(sql)
+            if params:
+                state.params.extend(params)
+            if auto_tables:
+                state.auto_tables.extend(auto_tables)
+            if join_tables:
+                state.join_tables.extend(join_tables)
+    if isinstance(f, types.FunctionType):
+        deco = wraps(f)(deco)
+        deco.__dict__.pop('iterate', None)  # The result should be cached, so the handler can't be iterated.
+    deco.__wrapped__ = f
     return deco
 
 
 @compile.when(object)
 def compile_object(compile, expr, state):
-    state.sql.append(PLACEHOLDER)
     state.params.append(expr)
+    paramstyle = state.paramstyle or compile._registry.paramstyle
+    state.sql.append(
+        paramstyle.placeholder or paramstyle.placeholder_template.format(state.param_offset + len(state.params))
+    )
 
 
 @compile.when(type(None))
@@ -233,8 +950,9 @@ def compile_none(compile, expr, state):
 
 @compile.when(list)
 @compile.when(tuple)
+@iterative
 def compile_list(compile, expr, state):
-    compile(Parentheses(ExprList(*expr).join(", ")), state)
+    yield Parentheses(ExprList(*expr).join(", "))
 
 
 @compile.when(slice)
@@ -248,10 +966,6 @@ def compile_slice(compile, expr, state):
     state.sql.append("]")
 
 
-class Error(Exception):
-    pass
-
-
 class UndefType(object):
 
     def __repr__(self):
@@ -514,8 +1228,29 @@ class Expr(Comparable):
         return _repr(self)
 
 
+raw_format_re = re.compile(r'(%%|%s)')
+
+
 @compile.when(Expr)
 def compile_expr(compile, expr, state):
+    paramstyle = state.paramstyle or compile._registry.paramstyle
+    if expr.params and paramstyle.placeholder != PLACEHOLDER and isinstance(expr.sql, string_types):
+        # Raw SQL with params uses placeholders and escaping of "format" paramstyle,
+        # they are converted to paramstyle of compiler. Raw SQL without params is passed as is.
+        parts = raw_format_re.split(expr.sql)
+        if parts.count(PLACEHOLDER) != len(expr.params):
+            raise Error("Count of placeholders in {0!r} doesn't match count of params".format(expr.sql))
+        percent = '%%' if paramstyle.escape_percent else '%'
+        compile_object = compile.get_handler(object)
+        params = iter(expr.params)
+        state.sql.append(parts[0])
+        for i in range(1, len(parts), 2):
+            if parts[i] == PLACEHOLDER:
+                compile_object(compile, next(params), state)
+            else:
+                state.sql.append(percent)
+            state.sql.append(parts[i + 1])
+        return
     state.sql.append(expr.sql)
     state.params += expr.params
 
@@ -557,11 +1292,12 @@ class CompositeExpr(object):
 
 
 @compile.when(CompositeExpr)
+@iterative
 def compile_compositeexpr(compile, expr, state):
-    state.push('callers')
-    state.callers.pop(0)  # pop CompositeExpr from caller's stack to correct render of aliases.
-    compile_exprlist(compile, expr, state)
-    state.pop()
+    caller = state.callers.pop()  # pop CompositeExpr from caller's stack to correct render of aliases.
+    for child in compile_exprlist.iterate(compile, expr, state):
+        yield child
+    state.callers.append(caller)
 
 
 class Binary(Expr):
@@ -576,12 +1312,13 @@ Condition = Binary
 
 
 @compile.when(Binary)
+@iterative
 def compile_condition(compile, expr, state):
-    compile(expr.left, state)
+    yield expr.left
     state.sql.append(SPACE)
     state.sql.append(expr.sql)
     state.sql.append(SPACE)
-    compile(expr.right, state)
+    yield expr.right
 
 
 class NamedBinary(Binary):
@@ -597,11 +1334,61 @@ NamedCondition = NamedBinary
 
 
 class NamedCompound(NamedBinary):
-    __slots__ = ()
+    """Flat n-ary node, And(And(a, b), c) is stored as a single node with operands [a, b, c].
+
+    Chained nodes share the list of operands, each node owns its first _size items.
+    So chaining onto the last node of chain appends to the shared list in O(1),
+    and chaining onto any other node copies its own part of the list.
+    """
+    __slots__ = ('_data', '_size')
 
     def __init__(self, *exprs):
-        self.left = reduce(self.__class__, exprs[:-1])
-        self.right = exprs[-1]
+        cls = self.__class__
+        first = exprs[0]
+        if len(exprs) == 2 and first.__class__ is cls and exprs[1].__class__ is not cls:
+            data, size, operand = first._data, first._size, exprs[1]
+            if len(data) == size:
+                data.append(operand)
+            if data[size] is not operand:  # The shared list is already extended by another node.
+                data = data[:size]
+                data.append(operand)
+            self._data, self._size = data, size + 1
+            return
+        data = []
+        for expr in exprs:
+            if expr.__class__ is cls:
+                data.extend(expr.operands)
+            else:
+                data.append(expr)
+        self._data, self._size = data, len(data)
+
+    @property
+    def operands(self):
+        return tuple(self._data[:self._size])
+
+    @property
+    def left(self):
+        if self._size == 2:
+            return self._data[0]
+        left = self.__class__.__new__(self.__class__)
+        left._data, left._size = self._data, self._size - 1
+        return left
+
+    @property
+    def right(self):
+        return self._data[self._size - 1]
+
+
+@compile.when(NamedCompound)
+@iterative
+def compile_namedcompound(compile, expr, state):
+    data = expr._data
+    yield data[0]
+    for i in range(1, expr._size):
+        state.sql.append(SPACE)
+        state.sql.append(expr.sql)
+        state.sql.append(SPACE)
+        yield data[i]
 
 
 class Add(NamedCompound):
@@ -707,11 +1494,12 @@ class EscapeForLike(Expr):
 
 
 @compile.when(EscapeForLike)
+@iterative
 def compile_escapeforlike(compile, expr, state):
     escaped = expr.expr
     for k, v in expr.escape_map:
         escaped = func.Replace(escaped, Value(k), Value(v))
-    compile(escaped, state)
+    yield escaped
 
 
 class Like(NamedBinary):
@@ -736,11 +1524,13 @@ class ILike(Like):
 
 
 @compile.when(Like)
+@iterative
 def compile_like(compile, expr, state):
-    compile_condition(compile, expr, state)
+    for child in compile_condition.iterate(compile, expr, state):
+        yield child
     if expr.escape is not Undef:
         state.sql.append(' ESCAPE ')
-        compile(Value(expr.escape) if isinstance(expr.escape, string_types) else expr.escape, state)
+        yield Value(expr.escape) if isinstance(expr.escape, string_types) else expr.escape
 
 
 class ExprList(Expr):
@@ -794,12 +1584,13 @@ class ExprList(Expr):
         return self
 
     def __copy__(self):
-        dup = copy.copy(super(ExprList, self))
+        dup = copy_instance(self)
         dup.data = dup.data[:]
         return dup
 
 
 @compile.when(ExprList)
+@iterative
 def compile_exprlist(compile, expr, state):
     first = True
     for a in expr:
@@ -807,7 +1598,7 @@ def compile_exprlist(compile, expr, state):
             first = False
         else:
             state.sql.append(expr.sql)
-        compile(a, state)
+        yield a
 
 
 class FieldList(ExprList):
@@ -820,9 +1611,11 @@ class FieldList(ExprList):
 
 
 @compile.when(FieldList)
+@iterative
 def compile_fieldlist(compile, expr, state):
     # state.push('context', CONTEXT_COLUMN)
-    compile_exprlist(compile, expr, state)
+    for child in compile_exprlist.iterate(compile, expr, state):
+        yield child
     # state.pop()
 
 
@@ -858,28 +1651,46 @@ def compile_array(compile, expr, state):
 
 
 @compile.when(Concat)
+@iterative
 def compile_concat(compile, expr, state):
     if not expr.ws():
-        return compile_exprlist(compile, expr, state)
+        for child in compile_exprlist.iterate(compile, expr, state):
+            yield child
+        return
     state.sql.append('concat_ws(')
-    compile(expr.ws(), state)
+    yield expr.ws()
     for a in expr:
         state.sql.append(expr.sql)
-        compile(a, state)
+        yield a
     state.sql.append(')')
 
 
 class Param(Expr):
 
-    __slots__ = ()
+    __slots__ = ('name', )
 
-    def __init__(self, params):
+    def __init__(self, params=Undef, name=None):
+        """
+        :param params: value of param, or Undef for unbound param, see :class:`PreparedQuery`
+        :param name: name of param
+        """
         self.params = params
+        self.name = name
+
+    def __repr__(self):
+        if self.params is Undef:
+            return "<{0}: {1}>".format(type(self).__name__, self.name)
+        return _repr(self)
 
 
 @compile.when(Param)
+@iterative
 def compile_param(compile, expr, state):
-    compile(expr.params, state)
+    if expr.params is Undef:
+        # Unbound param is passed to the params as is, to be replaced by PreparedQuery.
+        compile.get_handler(object)(compile, expr, state)
+    else:
+        yield expr.params
 
 
 Placeholder = Param
@@ -894,9 +1705,10 @@ class Parentheses(Expr):
 
 
 @compile.when(Parentheses)
+@iterative
 def compile_parentheses(compile, expr, state):
     state.precedence += MAX_PRECEDENCE
-    compile(expr.expr, state)
+    yield expr.expr
 
 
 class OmitParentheses(Parentheses):
@@ -904,9 +1716,10 @@ class OmitParentheses(Parentheses):
 
 
 @compile.when(OmitParentheses)
+@iterative
 def compile_omitparentheses(compile, expr, state):
     state.precedence = 0
-    compile(expr.expr, state)
+    yield expr.expr
 
 
 class Prefix(Expr):
@@ -919,10 +1732,11 @@ class Prefix(Expr):
 
 
 @compile.when(Prefix)
+@iterative
 def compile_prefix(compile, expr, state):
     state.sql.append(expr.sql)
     state.sql.append(SPACE)
-    compile(expr.expr, state)
+    yield expr.expr
 
 
 class NamedPrefix(Prefix):
@@ -957,9 +1771,10 @@ class Unary(Prefix):
 
 
 @compile.when(Unary)
+@iterative
 def compile_unary(compile, expr, state):
     state.sql.append(expr.sql)
-    compile(expr.expr, state)
+    yield expr.expr
 
 
 class NamedUnary(Unary):
@@ -988,8 +1803,9 @@ class Postfix(Expr):
 
 
 @compile.when(Postfix)
+@iterative
 def compile_postfix(compile, expr, state):
-    compile(expr.expr, state)
+    yield expr.expr
     state.sql.append(SPACE)
     state.sql.append(expr.sql)
 
@@ -1032,16 +1848,17 @@ class Ternary(Expr):
 
 
 @compile.when(Ternary)
+@iterative
 def compile_ternary(compile, expr, state):
-    compile(expr.first, state)
+    yield expr.first
     state.sql.append(SPACE)
     state.sql.append(expr.sql)
     state.sql.append(SPACE)
-    compile(expr.second, state)
+    yield expr.second
     state.sql.append(SPACE)
     state.sql.append(expr.second_sql)
     state.sql.append(SPACE)
-    compile(expr.third, state)
+    yield expr.third
 
 
 class NamedTernary(Ternary):
@@ -1074,19 +1891,20 @@ class Case(Expr):
 
 
 @compile.when(Case)
+@iterative
 def compile_case(compile, expr, state):
     state.sql.append('CASE')
     if expr.expr is not Undef:
         state.sql.append(SPACE)
-        compile(expr.expr, state)
+        yield expr.expr
     for clause, value in expr.cases:
         state.sql.append(' WHEN ')
-        compile(clause, state)
+        yield clause
         state.sql.append(' THEN ')
-        compile(value, state)
+        yield value
     if expr.default is not Undef:
         state.sql.append(' ELSE ')
-        compile(expr.default, state)
+        yield expr.default
     state.sql.append(' END ')
 
 
@@ -1100,10 +1918,11 @@ class Callable(Expr):
 
 
 @compile.when(Callable)
+@iterative
 def compile_callable(compile, expr, state):
-    compile(expr.expr, state)
+    yield expr.expr
     state.sql.append('(')
-    compile(expr.args, state)
+    yield expr.args
     state.sql.append(')')
 
 
@@ -1115,10 +1934,11 @@ class NamedCallable(Callable):
 
 
 @compile.when(NamedCallable)
+@iterative
 def compile_namedcallable(compile, expr, state):
     state.sql.append(expr.sql)
     state.sql.append('(')
-    compile(expr.args, state)
+    yield expr.args
     state.sql.append(')')
 
 
@@ -1132,10 +1952,11 @@ class Cast(NamedCallable):
 
 
 @compile.when(Cast)
+@iterative
 def compile_cast(compile, expr, state):
     state.sql.append(expr.sql)
     state.sql.append('(')
-    compile(expr.expr, state)
+    yield expr.expr
     state.sql.append(' AS ')
     state.sql.append(expr.type)
     state.sql.append(')')
@@ -1286,6 +2107,7 @@ class Alias(Expr):
 
 
 @compile.when(Alias)
+@iterative
 def compile_alias(compile, expr, state):
     try:
         render_column = issubclass(state.callers[1], FieldList)
@@ -1294,9 +2116,9 @@ def compile_alias(compile, expr, state):
         pass
     else:
         if render_column:
-            compile(expr.expr, state)
+            yield expr.expr
             state.sql.append(' AS ')
-    compile(expr.sql, state)
+    yield expr.sql
 
 
 class MetaTableSpace(type):
@@ -1449,8 +2271,10 @@ class Table(MetaTable("NewBase", (object, ), {})):
 
 
 @compile.when(Table)
+@cached_compile
+@iterative
 def compile_table(compile, expr, state):
-    compile(expr._name, state)
+    yield expr._name
 
 
 @factory.register
@@ -1470,6 +2294,7 @@ class TableAlias(Table):
 
 
 @compile.when(TableAlias)
+@iterative
 def compile_tablealias(compile, expr, state):
     # if expr._table is not None and state.context == CONTEXT_TABLE:
     try:
@@ -1479,9 +2304,9 @@ def compile_tablealias(compile, expr, state):
         pass
     else:
         if render_table:
-            compile(expr._table, state)
+            yield expr._table
             state.sql.append(' AS ')
-    compile(expr._name, state)
+    yield expr._name
 
 
 @factory.register
@@ -1560,7 +2385,7 @@ class TableJoin(object):
         return self
 
     def __copy__(self):
-        dup = copy.copy(super(TableJoin, self))
+        dup = copy_instance(self)
         for a in ['_hint', ]:
             setattr(dup, a, copy.copy(getattr(dup, a, None)))
         return dup
@@ -1578,11 +2403,12 @@ class TableJoin(object):
 
 
 @compile.when(TableJoin)
+@iterative
 def compile_tablejoin(compile, expr, state):
     if expr._nested:
         state.sql.append('(')
     if expr._left is not None:
-        compile(expr._left, state)
+        yield expr._left
     if expr._join_type:
         state.sql.append(SPACE)
         if expr._natural:
@@ -1590,17 +2416,17 @@ def compile_tablejoin(compile, expr, state):
         state.sql.append(expr._join_type)
         state.sql.append(SPACE)
     state.push('context', CONTEXT_TABLE)
-    compile(expr._table, state)
+    yield expr._table
     state.pop()
     if expr._on is not None:
         state.sql.append(' ON ')
-        compile(expr._on, state)
+        yield expr._on
     elif expr._using is not None:
         state.sql.append(' USING ')
-        compile(expr._using, state)
+        yield expr._using
     if expr._hint is not None:
         state.sql.append(SPACE)
-        compile(expr._hint, state)
+        yield expr._hint
     if expr._nested:
         state.sql.append(')')
 
@@ -1629,7 +2455,7 @@ class Result(object):
         return c
 
     def clone(self):
-        c = copy.copy(super(Result, self))
+        c = copy_instance(self)
         c._query = None
         return c
 
@@ -1757,7 +2583,7 @@ class Select(Expr):
         c = self.clone()
         if not isinstance(c._tables, TableJoin):
             raise Error("Can't set on without join table")
-        c._tables = c._tables.on(cond)
+        c._tables = copy.copy(c._tables).on(cond)
         return c
 
     def where(self, cond=None, op=operator.and_):
@@ -1836,9 +2662,10 @@ class Select(Expr):
         return Factory.get(self).TableAlias(alias, self)
 
     def clone(self, *attrs):
-        c = copy.copy(super(Select, self))
-        # if not attrs:
-        #     attrs = ('_fields', '_tables', '_group_by', '_order_by')
+        # Clauses are shared by clones, so clone() is O(1).
+        # Builder methods never change a shared clause, they replace it by a copy (attrs) with changes,
+        # so an instance can be safely cached and shared between threads.
+        c = copy_instance(self)
         for a in attrs:
             setattr(c, a, copy.copy(getattr(c, a, None)))
         return c
@@ -1848,6 +2675,7 @@ class Select(Expr):
 
 
 @compile.when(Select)
+@iterative
 def compile_query(compile, expr, state):
     state.push("auto_tables", [])  # this expr can be a subquery
     state.sql.append("SELECT ")
@@ -1855,31 +2683,31 @@ def compile_query(compile, expr, state):
         state.sql.append("DISTINCT ")
         if expr.distinct()[0] is not True:
             state.sql.append("ON ")
-            compile(Parentheses(expr._distinct), state)
+            yield Parentheses(expr._distinct)
             state.sql.append(SPACE)
-    compile(expr.fields(), state)
+    yield expr.fields()
 
     tables_sql_pos = len(state.sql)
     tables_params_pos = len(state.params)
 
     if expr.where():
         state.sql.append(" WHERE ")
-        compile(expr.where(), state)
+        yield expr.where()
     if expr.group_by():
         state.sql.append(" GROUP BY ")
-        compile(expr.group_by(), state)
+        yield expr.group_by()
     if expr.having():
         state.sql.append(" HAVING ")
-        compile(expr.having(), state)
+        yield expr.having()
     if expr.order_by():
         state.sql.append(" ORDER BY ")
-        compile(expr.order_by(), state)
+        yield expr.order_by()
     if expr._limit is not None:
         state.sql.append(" LIMIT ")
-        compile(expr._limit, state)
+        yield expr._limit
     if expr._offset:
         state.sql.append(" OFFSET ")
-        compile(expr._offset, state)
+        yield expr._offset
     if expr._for_update:
         state.sql.append(" FOR UPDATE")
 
@@ -1887,7 +2715,7 @@ def compile_query(compile, expr, state):
     state.push('sql', [])
     state.push('params', [])
     state.sql.append(" FROM ")
-    compile(expr.tables(), state)
+    yield expr.tables()
     tables_sql = state.sql
     tables_params = state.params
     state.pop()
@@ -1965,6 +2793,14 @@ class Query(Executable, Select):
     def raw(self, sql, params=()):
         return Factory.get(self).Raw(sql, params, result=self.result)
 
+    def prepare(self):
+        return PreparedQuery(self, self.result.compile)
+
+    def insert_chunks(self, values, max_params=None, **kw):
+        kw.setdefault('table', self._tables)
+        kw.setdefault('fields', self._fields)
+        return Factory.get(self).Insert(values=values, **kw).chunks(self.result.compile, max_params)
+
     def __getitem__(self, key):
         return self.result(self).__getitem__(key)
 
@@ -1974,6 +2810,9 @@ class Query(Executable, Select):
     def __iter__(self):
         return self.result(self).__iter__()
 
+    def __aiter__(self):
+        return self.result(self).__aiter__()
+
 
 QuerySet = Query
 
@@ -1995,27 +2834,78 @@ class Raw(Query):
 
 
 @compile.when(Raw)
+@iterative
 def compile_raw(compile, expr, state):
-    compile(expr._raw, state)
+    yield expr._raw
     if expr._limit is not None:
         state.sql.append(" LIMIT ")
-        compile(expr._limit, state)
+        yield expr._limit
     if expr._offset:
         state.sql.append(" OFFSET ")
-        compile(expr._offset, state)
+        yield expr._offset
 
 
 class Modify(object):
 
+    def prepare(self, compile=None):
+        return PreparedQuery(self, compile)
+
     def __repr__(self):
         return _repr(self)
 
 
+class PreparedQuery(object):
+    """Compiled query with unbound params, to execute it many times with new values.
+
+    Example: PreparedQuery(Q(T.author).fields('*').where(T.author.id == P(name='id')))(id=5)
+    """
+
+    compile = compile
+
+    def __init__(self, query, compile=None):
+        if compile is not None:
+            self.compile = compile
+        self.query = query
+        self.paramstyle = self.compile._registry.paramstyle
+        self.sql, self.params = self.compile._compile(query, self.paramstyle)
+        self.slots = tuple((i, p.name) for i, p in enumerate(self.params) if isinstance(p, Param))
+        names = []
+        for i, name in self.slots:
+            if name is None:
+                raise Error("Unbound param should have a name")
+            if name not in names:
+                names.append(name)
+        self.names = tuple(names)
+
+    def __call__(self, **values):
+        start = default_timer()
+        params = self.params[:]
+        try:
+            for i, name in self.slots:
+                params[i] = values[name]
+        except KeyError as e:
+            raise Error("Value of param {0!r} is not given".format(e.args[0]))
+        if len(values) > len(self.names):
+            unknown = sorted(set(values) - set(self.names))
+            raise TypeError("Unknown params: {0}".format(", ".join(unknown)))
+        params = self.paramstyle.format_params(params)
+        if self.compile._hooks:
+            self.compile._fire_hooks(self.query, self.sql, params, start)
+        return self.sql, params
+
+    def __repr__(self):
+        return "<{0}: {1}, {2!r}>".format(type(self).__name__, self.sql, self.params)
+
+
 @factory.register
 class Insert(Modify):
 
-    def __init__(self, table, map=None, fields=None, values=None, ignore=False, on_duplicate_key_update=None):
+    def __init__(self, table, map=None, fields=None, values=None, ignore=False, on_duplicate_key_update=None,
+                 columns=None):
         self.table = table
+        if columns is not None:
+            fields = list(columns.keys())
+            values = Columns(columns.values())
         self.fields = FieldList(*(k if isinstance(k, Expr) else Field(k) for k in (map or fields)))
         self.values = (tuple(map.values()),) if map else values
         self.ignore = ignore
@@ -2024,20 +2914,25 @@ class Insert(Modify):
             for k, v in on_duplicate_key_update.items()
         ) if on_duplicate_key_update else None
 
+    def chunks(self, compile=None, max_params=None):
+        return InsertChunks(self, compile, max_params)
+
 
 @compile.when(Insert)
+@iterative
 def compile_insert(compile, expr, state):
     state.sql.append("INSERT ")
     state.sql.append("INTO ")
-    compile(expr.table, state)
+    yield expr.table
     state.sql.append(SPACE)
-    compile(Parentheses(expr.fields), state)
+    yield Parentheses(expr.fields)
     if isinstance(expr.values, Query):
         state.sql.append(SPACE)
-        compile(expr.values, state)
+        yield expr.values
     else:
         state.sql.append(" VALUES ")
-        compile(ExprList(*expr.values).join(', '), state)
+        for child in iterate_values(compile, expr.values, state):
+            yield child
     if expr.ignore:
         state.sql.append(" ON CONFLICT DO NOTHING")
     elif expr.on_duplicate_key_update:
@@ -2048,9 +2943,212 @@ def compile_insert(compile, expr, state):
                 first = False
             else:
                 state.sql.append(", ")
-            compile(f, state)
+            yield f
             state.sql.append(" = ")
-            compile(v, state)
+            yield v
+
+
+class Columns(object):
+    """Rows of VALUES, given by columns.
+
+    Column can be any sequence, like list, array.array, memoryview or numpy.ndarray.
+    Columns are read by slices of chunk_size values, slices of buffers are converted to Python objects
+    by their tolist() method, so neither columns nor rows are copied as a whole.
+    """
+
+    chunk_size = 4096
+
+    def __init__(self, columns):
+        self.data = [
+            column if hasattr(column, '__len__') and hasattr(column, '__getitem__') else list(column)
+            for column in columns
+        ]
+        if len(set(len(column) for column in self.data)) > 1:
+            raise Error("Columns should have the same length")
+        self._types = {}
+
+    @staticmethod
+    def _get_slice(column, start, stop):
+        values = column[start:stop]
+        tolist = getattr(values, 'tolist', None)
+        return tolist() if tolist is not None else values
+
+    def iter_chunks(self, size=None):
+        """Yields pairs (start, list of slices of columns), up to size rows each."""
+        size = size or self.chunk_size
+        for start in range(0, len(self), size):
+            yield start, [self._get_slice(column, start, start + size) for column in self.data]
+
+    def get_types(self, start, chunk):
+        """Returns set of classes of values of the chunk, which is started from row start."""
+        key = (start, len(chunk[0]))
+        try:
+            return self._types[key]
+        except KeyError:
+            types = self._types[key] = set()
+            for column in chunk:
+                types.update(map(type, column))
+            return types
+
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+
+    def __iter__(self):
+        for start, chunk in self.iter_chunks():
+            for row in zip(*chunk):
+                yield row
+
+
+def is_plain_row(compile, row):
+    is_plain = compile.is_plain
+    for value in row:
+        if not is_plain(value.__class__):
+            return False
+    return True
+
+
+def iterate_values(compile, rows, state):
+    """Renders rows of VALUES, yields nested expressions like iterative handler.
+
+    Rows of plain values and None are rendered by template, their values are added to params by one extend().
+    """
+    if isinstance(rows, Columns):
+        return iterate_columns(compile, rows, state)
+    return iterate_rows(compile, rows, state)
+
+
+def iterate_columns(compile, columns, state):
+    """Renders Columns by chunks, chunks of plain values are rendered by template without building of rows."""
+    is_plain = compile.is_plain
+    row_sql = compile._get_row_template((False,) * len(columns.data), state)
+    first = True
+    for start, chunk in columns.iter_chunks(state.buffer_size):
+        if row_sql is not None and all(is_plain(cls) for cls in columns.get_types(start, chunk)):
+            if not first:
+                state.flush(True)  # The block is large enough.
+                state.sql.append(", ")
+            state.sql.append(compile._render_rows(row_sql, state, len(chunk[0])))
+            state.params.extend(itertools.chain.from_iterable(zip(*chunk)))
+        else:
+            for child in iterate_rows(compile, zip(*chunk), state, first):
+                yield child
+        first = False
+
+
+def iterate_rows(compile, rows, state, first=True):
+    is_plain = compile.is_plain
+    get_row_template = compile._get_row_template
+    for row in rows:
+        if first:
+            first = False
+        else:
+            state.flush()
+            state.sql.append(", ")
+        if row.__class__ in (tuple, list):
+            has_nulls = False
+            for value in row:
+                if value is None:
+                    has_nulls = True
+                elif not is_plain(value.__class__):
+                    break
+            else:
+                if has_nulls:
+                    row_sql = get_row_template(tuple(value is None for value in row), state)
+                    values = [value for value in row if value is not None]
+                else:
+                    row_sql = get_row_template((False,) * len(row), state)
+                    values = row
+                if row_sql is not None:
+                    if row_sql.__class__ is tuple:
+                        row_sql = compile._render_rows(row_sql, state)
+                    state.sql.append(row_sql)
+                    state.params.extend(values)
+                    continue
+        yield row
+
+
+class InsertChunks(object):
+    """Splits Insert with many rows to statements, which don't exceed max count of params of database.
+
+    Example: for sql, params in Insert(T.author, fields=('name',), values=rows).chunks(): cursor.execute(sql, params)
+    """
+
+    compile = compile
+
+    def __init__(self, query, compile=None, max_params=None):
+        if compile is not None:
+            self.compile = compile
+        self.query = query
+        self.max_params = max_params or self.compile.max_params
+        self.paramstyle = self.compile._registry.paramstyle
+        self._templates = {}  # Count of rows => (sql, params, position of values in params)
+
+    def __iter__(self):
+        query = self.query
+        if isinstance(query.values, Query):
+            yield self.compile(query)
+            return
+        width = max(len(query.fields), 1)
+        template = self._get_template(1, width)
+        extra = len(template[1]) - width if template else 0
+        size = max((self.max_params - extra) // width, 1)
+        rows = iter(query.values)
+        while True:
+            chunk = list(itertools.islice(rows, size))
+            if not chunk:
+                return
+            for result in self._compile_chunk(chunk, width):
+                yield result
+
+    def _compile_chunk(self, chunk, width):
+        start_time = default_timer()
+        if all(self._is_plain(row, width) for row in chunk):
+            template = self._get_template(len(chunk), width)
+            if template is not None:
+                sql, params, start = template
+                params = params[:]
+                params[start:start + len(chunk) * width] = [value for row in chunk for value in row]
+                yield self._result(sql, params, start_time)
+                return
+        query = copy.copy(self.query)
+        query.values = chunk
+        sql, params = self.compile._compile(query, self.paramstyle)
+        if len(params) > self.max_params and len(chunk) > 1:
+            half = len(chunk) // 2
+            for part in (chunk[:half], chunk[half:]):
+                for result in self._compile_chunk(part, width):
+                    yield result
+        else:
+            yield self._result(sql, params, start_time)
+
+    def _result(self, sql, params, start_time):
+        """Returns statement of the chunk, hooks of compiler are fired for each statement."""
+        params = self.paramstyle.format_params(params)
+        if self.compile._hooks:
+            self.compile._fire_hooks(self.query, sql, params, start_time)
+        return sql, params
+
+    def _is_plain(self, row, width):
+        return isinstance(row, (list, tuple)) and len(row) == width and is_plain_row(self.compile, row)
+
+    def _get_template(self, count, width):
+        try:
+            return self._templates[count]
+        except KeyError:
+            pass
+        markers = [tuple(Param() for i in range(width)) for j in range(count)]
+        query = copy.copy(self.query)
+        query.values = markers
+        sql, params = self.compile._compile(query, self.paramstyle)
+        markers = [marker for row in markers for marker in row]
+        template = None
+        for start, param in enumerate(params):
+            if param is markers[0]:
+                if all(a is b for a, b in zip(params[start:start + len(markers)], markers)):
+                    template = (sql, params, start)
+                break
+        self._templates[count] = template
+        return template
 
 
 @factory.register
@@ -2067,11 +3165,12 @@ class Update(Modify):
 
 
 @compile.when(Update)
+@iterative
 def compile_update(compile, expr, state):
     state.sql.append("UPDATE ")
     if expr.ignore:
         state.sql.append("IGNORE ")
-    compile(expr.table, state)
+    yield expr.table
     state.sql.append(" SET ")
     first = True
     for f, v in zip(expr.fields, expr.values):
@@ -2079,18 +3178,18 @@ def compile_update(compile, expr, state):
             first = False
         else:
             state.sql.append(", ")
-        compile(f, state)
+        yield f
         state.sql.append(" = ")
-        compile(v, state)
+        yield v
     if expr.where:
         state.sql.append(" WHERE ")
-        compile(expr.where, state)
+        yield expr.where
     if expr.order_by:
         state.sql.append(" ORDER BY ")
-        compile(expr.order_by, state)
+        yield expr.order_by
     if expr.limit is not None:
         state.sql.append(" LIMIT ")
-        compile(expr.limit, state)
+        yield expr.limit
 
 
 @factory.register
@@ -2104,18 +3203,161 @@ class Delete(Modify):
 
 
 @compile.when(Delete)
+@iterative
 def compile_delete(compile, expr, state):
     state.sql.append("DELETE FROM ")
-    compile(expr.table, state)
+    yield expr.table
     if expr.where:
         state.sql.append(" WHERE ")
-        compile(expr.where, state)
+        yield expr.where
     if expr.order_by:
         state.sql.append(" ORDER BY ")
-        compile(expr.order_by, state)
+        yield expr.order_by
     if expr.limit is not None:
         state.sql.append(" LIMIT ")
-        compile(expr.limit, state)
+        yield expr.limit
+
+
+@factory.register
+class Copy(Modify):
+    """COPY table (fields) FROM STDIN statement of PostgreSQL, use encoder() to encode rows to its data."""
+
+    def __init__(self, table, fields=None, format=None, delimiter=None, null=None, header=None, quote=None,
+                 escape=None, encoding=None):
+        self.table = table
+        self.fields = FieldList(*(
+            Name(k) if isinstance(k, string_types) else getattr(k, '_name', k) for k in (fields or ())
+        ))
+        self.format = format
+        self.delimiter = delimiter
+        self.null = null
+        self.header = header
+        self.quote = quote
+        self.escape = escape
+        self.encoding = encoding
+
+    def get_options(self):
+        """Returns list of pairs (option, value) of given options."""
+        return [(k, getattr(self, k)) for k in ('format', 'delimiter', 'null', 'header', 'quote', 'escape', 'encoding')
+                if getattr(self, k) is not None]
+
+    def encoder(self):
+        header = [str(getattr(f, 'name', f)) for f in self.fields] if self.header else None
+        return CopyEncoder(self.format, self.delimiter, self.null, self.quote, self.escape, header)
+
+
+@compile.when(Copy)
+@iterative
+def compile_copy(compile, expr, state):
+    state.sql.append("COPY ")
+    yield expr.table
+    if expr.fields:
+        state.sql.append(SPACE)
+        yield Parentheses(expr.fields)
+    state.sql.append(" FROM STDIN")
+    options = expr.get_options()
+    if options:
+        state.sql.append(" WITH (")
+        first = True
+        for k, v in options:
+            if first:
+                first = False
+            else:
+                state.sql.append(", ")
+            state.sql.append(k.upper())
+            state.sql.append(SPACE)
+            if k == 'format':
+                if v.lower() not in ('text', 'csv', 'binary'):
+                    raise Error("Unknown format {0!r}".format(v))
+                state.sql.append(v.lower())
+            elif k == 'header':
+                state.sql.append('true' if v else 'false')
+            else:
+                # Options can't be passed as params. Data of COPY is not interpolated by drivers, so '%' is not escaped.
+                state.sql.append("'{0}'".format(v.replace("'", "''")))
+        state.sql.append(")")
+
+
+class CopyEncoder(object):
+    """Encodes rows to data of COPY FROM STDIN, in text or CSV format, by chunks.
+
+    Example: for chunk in Copy(T.author, fields=('name',)).encoder().iterencode(rows): copy.write(chunk)
+    """
+
+    chunk_size = 65536  # Min length of chunk, except the last one.
+
+    def __init__(self, format=None, delimiter=None, null=None, quote=None, escape=None, header=None):
+        self.format = (format or 'text').lower()
+        if self.format not in ('text', 'csv'):
+            raise Error("Format {0!r} is not supported by encoder".format(format))
+        csv = self.format == 'csv'
+        self.delimiter = delimiter or (',' if csv else '\t')
+        self.null = null if null is not None else ('' if csv else '\\N')
+        self.quote = quote or '"'
+        self.escape = escape or self.quote
+        self.header = header
+        if csv:
+            self._specials = (self.delimiter, self.quote, self.escape, '\n', '\r')
+        else:
+            self._replacements = (('\\', '\\\\'), ('\n', '\\n'), ('\r', '\\r'), (self.delimiter, '\\' + self.delimiter))
+
+    def iterencode(self, rows):
+        encode_row = self.encode_row
+        buffer = []
+        size = 0
+        if self.header:
+            buffer.append(encode_row(self.header))
+        for row in rows:
+            line = encode_row(row)
+            buffer.append(line)
+            size += len(line)
+            if size >= self.chunk_size:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield ''.join(buffer)
+
+    def write(self, rows, file):
+        for chunk in self.iterencode(rows):
+            file.write(chunk)
+
+    def encode_row(self, row):
+        encode_value = self.encode_value
+        return self.delimiter.join([encode_value(value) for value in row]) + '\n'
+
+    def encode_value(self, value):
+        if value is None:
+            return self.null
+        value = self.to_text(value)
+        if self.format == 'csv':
+            if value == self.null or value == '\\.' or any(c in value for c in self._specials):
+                if self.escape != self.quote:
+                    value = value.replace(self.escape, self.escape + self.escape)
+                return self.quote + value.replace(self.quote, self.escape + self.quote) + self.quote
+            return value
+        for k, v in self._replacements:
+            if k in value:
+                value = value.replace(k, v)
+        return value
+
+    @staticmethod
+    def to_text(value):
+        if isinstance(value, str):  # unicode in Python 2.*
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)):  # str in Python 2.* is binary too
+            return '\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, float):
+            if value != value:
+                return 'NaN'
+            if value in (float('inf'), float('-inf')):
+                return 'Infinity' if value > 0 else '-Infinity'
+            return repr(value)
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return str(value)
 
 
 @factory.register
@@ -2201,6 +3443,7 @@ class Except(Set):
 
 
 @compile.when(Set)
+@iterative
 def compile_set(compile, expr, state):
     if expr._all:
         op = ' {0} ALL '.format(expr.sql)
@@ -2208,33 +3451,38 @@ def compile_set(compile, expr, state):
         op = ' {0} '.format(expr.sql)
     # TODO: add tests for nested sets.
     state.precedence += 0.5  # to correct handle sub-set with limit, offset
-    compile(expr._exprs.join(op), state)
+    yield expr._exprs.join(op)
     state.precedence -= 0.5
     if expr._order_by:
         state.sql.append(" ORDER BY ")
-        compile(expr._order_by, state)
+        yield expr._order_by
     if expr._limit is not None:
         state.sql.append(" LIMIT ")
-        compile(expr._limit, state)
+        yield expr._limit
     if expr._offset:
         state.sql.append(" OFFSET ")
-        compile(expr._offset, state)
+        yield expr._offset
     if expr._for_update:
         state.sql.append(" FOR UPDATE")
 
 
 class Name(object):
 
-    __slots__ = ('name', )
+    __slots__ = ('name', '__cached__')
 
     def __init__(self, name=None):
         self.name = name
+        self.__cached__ = {}
 
     def __repr__(self):
         return _repr(self)
 
 
-class NameCompiler(object):
+class Quoter(object):
+    """Base of NameCompiler and ValueCompiler, escapes and quotes strings, keeps cache of quoted strings.
+
+    Percent sign is escaped only for paramstyles, which use it, see Compiler.paramstyle.
+    """
 
     _translation_map = (
         ("\\", "\\\\"),
@@ -2247,32 +3495,67 @@ class NameCompiler(object):
     )
     _delimiter = '"'
     _escape_delimiter = '"'
-    _max_length = 63
-
-    class MaxLengthError(Error):
-        pass
+    _cache_size = 1024  # Max count of quoted strings in cache, 0 to disable cache.
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, '_{}'.format(k), v)
+        self._percent_escape = dict(self._translation_map).get('%')
+        self._replacements = (
+            ((self._delimiter, self._escape_delimiter + self._delimiter),) +
+            tuple((k, v) for k, v in self._translation_map if k != '%')
+        )
+        self._cache = {}
+
+    def _escape(self, value):
+        # The check is much cheaper than replace() without matches, and most of strings don't need escaping.
+        # str.translate() and re.sub() are single-pass, but they are several times slower
+        # for replacements longer than one character.
+        for k, v in self._replacements:
+            if k in value:
+                value = value.replace(k, v)
+        return value
+
+    def _escape_percent(self, compile, state, quoted):
+        if self._percent_escape is not None and '%' in quoted:
+            if (state.paramstyle or compile._registry.paramstyle).escape_percent:
+                return quoted.replace('%', self._percent_escape)
+        return quoted
+
+    def _cache_put(self, key, value):
+        if self._cache_size:
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[key] = value
+
+
+class NameCompiler(Quoter):
+
+    _max_length = 63
+
+    class MaxLengthError(Error):
+        pass
 
     def __call__(self, compile, expr, state):
-        state.sql.append(self._delimiter)
         name = expr.name
-        name = name.replace(self._delimiter, self._escape_delimiter + self._delimiter)
-        for k, v in self._translation_map:
-            name = name.replace(k, v)
-        if len(name) > self._get_max_length(state):
-            raise self.MaxLengthError("The length of name {0!r} is more than {1}".format(name, self._max_length))
-        state.sql.append(name)
-        state.sql.append(self._delimiter)
+        try:
+            length, quoted = self._cache[name]  # name => (length of escaped name, quoted name)
+        except KeyError:
+            escaped = self._escape(name)
+            length, quoted = len(escaped), self._delimiter + escaped + self._delimiter
+            self._cache_put(name, (length, quoted))
+        if length > self._get_max_length(state):
+            raise self.MaxLengthError("The length of name {0!r} is more than {1}".format(
+                self._escape(name), self._max_length
+            ))
+        state.sql.append(self._escape_percent(compile, state, quoted))
 
     def _get_max_length(self, state):
         # Max length can depend on context.
         return self._max_length
 
 compile_name = NameCompiler()
-compile.when(Name)(compile_name)
+compile.when(Name)(cached_compile(compile_name))
 
 
 class Value(object):
@@ -2286,38 +3569,298 @@ class Value(object):
         return _repr(self)
 
 
-class ValueCompiler(object):
+class ValueCompiler(Quoter):
 
-    _translation_map = (
-        ("\\", "\\\\"),
-        ("\000", "\\0"),
-        ('\b', '\\b'),
-        ('\n', '\\n'),
-        ('\r', '\\r'),
-        ('\t', '\\t'),
-        ("%", "%%")
-    )
     _delimiter = "'"
     _escape_delimiter = "'"
-
-    def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, '_{}'.format(k), v)
+    _cache_max_length = 64  # Longer literals are not cached.
 
     def __call__(self, compile, expr, state):
-        state.sql.append(self._delimiter)
         value = str(expr.value)
-        value = value.replace(self._delimiter, self._escape_delimiter + self._delimiter)
-        for k, v in self._translation_map:
-            value = value.replace(k, v)
-        state.sql.append(value)
-        state.sql.append(self._delimiter)
+        try:
+            quoted = self._cache[value]  # literal => quoted literal
+        except KeyError:
+            quoted = self._delimiter + self._escape(value) + self._delimiter
+            if len(value) <= self._cache_max_length:
+                self._cache_put(value, quoted)
+        state.sql.append(self._escape_percent(compile, state, quoted))
 
 
 compile_value = ValueCompiler()
 compile.when(Value)(compile_value)
 
 
+class TemplateLayout(object):
+    """Positions of params and of parts of SQL in leaves of expression, see TemplateCache."""
+
+    __slots__ = ('param_positions', 'sql_positions', 'get_params', 'get_sql_values')
+
+    def __init__(self, param_positions, sql_positions):
+        self.param_positions = param_positions
+        self.sql_positions = sql_positions
+        self.get_params = self.make_getter(param_positions)
+        self.get_sql_values = self.make_getter(sql_positions)
+
+    @staticmethod
+    def make_getter(positions):
+        """Returns function, which returns tuple of items of list (or dict) at given positions (or keys)."""
+        if len(positions) > 1:
+            return operator.itemgetter(*positions)
+        elif positions:
+            position = positions[0]
+            return lambda items: (items[position],)
+        return lambda items: ()
+
+
+class TemplateCache(object):
+    """Caches rendered SQL by structure of expression, ignoring values of params.
+
+    Usage: compile.template_cache(query) returns the same (sql, params) as compile(query).
+
+    Layout of each structure is learned from the first compiling of it: a leaf of expression tree
+    is a param if it is passed to the params by the compiler, otherwise it is a part of SQL,
+    so its value goes to the key of cache. Handlers should not branch on values of params,
+    except truthiness and comparison with None.
+    """
+
+    attributes = {}  # Class => names of attributes, which are compiled. Default is all slots and __dict__.
+    immutable = ()  # Classes of attributes, which are never changed, their parts of structure are memoized.
+    exclude = ('__cached__', '__factory__', 'result')
+
+    def __init__(self, compile, maxsize=1024):
+        self.compile = compile
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        registry = self.compile._registry
+        registry.template_layouts.clear()
+        registry.templates.clear()
+        registry.template_kinds.clear()
+
+    def __len__(self):
+        return len(self.compile._registry.templates)
+
+    def __call__(self, expr):
+        # Templates are stored in the snapshot of registry, which is taken before compiling,
+        # so SQL, rendered by old handlers, never gets to storage of new handlers.
+        registry = self.compile._registry
+        if self.compile._hooks:
+            start = default_timer()
+            sql, params = self._get(expr, registry)
+            params = registry.paramstyle.format_params(params)
+            self.compile._fire_hooks(expr, sql, params, start)
+            return sql, params
+        sql, params = self._get(expr, registry)
+        return sql, registry.paramstyle.format_params(params)
+
+    def _get(self, expr, registry):
+        leaves = []
+        structure = self.fingerprint(expr, leaves, registry)
+        try:
+            layout = registry.template_layouts[structure]
+            key = (layout, layout.get_sql_values(leaves))
+            sql = registry.templates.pop(key)
+        except (KeyError, TypeError):
+            return self._compile(expr, structure, leaves, registry)
+        registry.templates[key] = sql
+        self.hits += 1
+        return sql, list(layout.get_params(leaves))
+
+    def _compile(self, expr, structure, leaves, registry):
+        self.misses += 1
+        sql, params = self.compile._compile(expr, registry.paramstyle)
+        positions = self._get_layout(leaves, params)
+        if positions is None:
+            return sql, params
+        layout = registry.template_layouts.get(structure)
+        if layout is None or (layout.param_positions, layout.sql_positions) != positions:
+            # Layout of the structure can depend on values (see _get_layout()), the latest is used.
+            layout = TemplateLayout(*positions)
+        try:
+            key = (layout, layout.get_sql_values(leaves))
+            hash(key)
+        except TypeError:
+            return sql, params
+        self._put(registry.template_layouts, structure, layout)
+        self._put(registry.templates, key, sql)
+        return sql, params
+
+    def _put(self, cache, key, value):
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > self.maxsize:
+            try:
+                cache.popitem(last=False)
+            except KeyError:  # Emptied by concurrent clear()
+                break
+
+    @staticmethod
+    def _get_layout(leaves, params):
+        """Returns pair of (positions of params, positions of parts of SQL) in leaves, or None."""
+        positions = {}
+        for i, leaf in enumerate(leaves):
+            positions.setdefault(id(leaf), []).append(i)
+        param_positions = []
+        ambiguous = set()
+        for param in params:
+            leaf_positions = positions.get(id(param))
+            if leaf_positions is None:
+                return None  # The param is computed by compiler, so we can't bind it.
+            param_positions.append(leaf_positions[0])
+            if len(leaf_positions) > 1:
+                # The same object is in several leaves (interned int, repeated string), we don't know,
+                # which of them are params, so all of them go to the key, and the template is reused
+                # only for the same values at these positions.
+                ambiguous.update(leaf_positions)
+        param_positions_set = set(param_positions) - ambiguous
+        sql_positions = tuple(i for i in range(len(leaves)) if i not in param_positions_set)
+        return tuple(param_positions), sql_positions
+
+    # Kinds of classes for fingerprint()
+    NONE, LEAF, VALUE, LIST, NODE, SPARSE_NODE, NODE1, DICT_NODE, IMMUTABLE = range(9)
+
+    def fingerprint(self, expr, leaves, registry=None):
+        """Returns structure of expression as flat tuple, leaves of expression are appended to the list.
+
+        The tree is walked without recursion, in pre-order. Each node adds its class to the structure,
+        a sequence adds also its length, and a leaf of LEAF_TYPES adds its truthiness.
+        """
+        structure = []
+        self._walk(expr, structure, leaves, registry or self.compile._registry)
+        return tuple(structure)
+
+    def _walk(self, expr, structure, leaves, registry):
+        NONE, NODE, SPARSE_NODE, NODE1, VALUE, LEAF, LIST, DICT_NODE, IMMUTABLE = (
+            self.NONE, self.NODE, self.SPARSE_NODE, self.NODE1, self.VALUE, self.LEAF, self.LIST, self.DICT_NODE,
+            self.IMMUTABLE,
+        )
+        kinds = registry.template_kinds
+        cache_key = (id(self.compile), TemplateCache)
+        cache_token = registry.cache_token
+        append = structure.append
+        append_leaf = leaves.append
+        stack = [expr]
+        pop = stack.pop
+        push = stack.append
+        extend = stack.extend
+        while stack:
+            obj = pop()
+            cls = obj.__class__
+            try:
+                kind, getter, attrs = kinds[cls]
+            except KeyError:
+                kind, getter, attrs = kinds[cls] = self._get_kind(cls, registry)
+            if kind == IMMUTABLE:
+                try:
+                    token, part, part_leaves = obj.__cached__[cache_key]
+                except KeyError:
+                    token = None
+                if token is not cache_token:
+                    token, part, part_leaves = self._walk_immutable(obj, registry)
+                structure.extend(part)
+                leaves.extend(part_leaves)
+                continue
+            append(cls)
+            if kind == NODE:
+                try:
+                    extend(reversed(getter(obj)))
+                except AttributeError:
+                    # Slot is not set, for example Expr.params of subclasses, which don't call Expr.__init__().
+                    kinds[cls] = (SPARSE_NODE, None, attrs)
+                    extend(reversed([getattr(obj, attr, Undef) for attr in attrs]))
+            elif kind == SPARSE_NODE:
+                extend(reversed([getattr(obj, attr, Undef) for attr in attrs]))
+            elif kind == VALUE:
+                append_leaf(obj)
+                append(not obj)
+            elif kind == NONE:
+                pass
+            elif kind == NODE1:
+                push(getattr(obj, attrs[0], Undef))
+            elif kind == LEAF:
+                append_leaf(obj)
+            elif kind == LIST:
+                append(len(obj))
+                extend(reversed(obj))
+            elif kind == DICT_NODE:
+                values = obj.__dict__
+                keys = tuple(values)
+                try:
+                    names, get_values = getter[keys]
+                except KeyError:
+                    names = tuple(sorted(key for key in keys if key not in self.exclude))
+                    get_values = TemplateLayout.make_getter(names)
+                    getter[keys] = (names, get_values)  # Getter of values of __dict__ by its keys
+                append(names)
+                extend(reversed(get_values(values)))
+                extend(reversed([getattr(obj, attr, Undef) for attr in attrs]))
+
+    def _walk_immutable(self, obj, registry):
+        """Returns part of structure and leaves of immutable node, they are memoized in obj.__cached__.
+
+        The part isn't memoized, if the node refers to a mutable node, for example field of subquery.
+        """
+        kinds = registry.template_kinds
+        part, part_leaves = [obj.__class__], []
+        memoize = True
+        for attr in kinds[obj.__class__][2]:
+            value = getattr(obj, attr, Undef)
+            self._walk(value, part, part_leaves, registry)
+            memoize = memoize and kinds[value.__class__][0] in (self.NONE, self.VALUE, self.IMMUTABLE)
+        entry = (registry.cache_token, tuple(part), tuple(part_leaves))
+        if memoize:
+            obj.__cached__[(id(self.compile), TemplateCache)] = entry
+        return entry
+
+    def _get_kind(self, cls, registry):
+        """Returns triple (kind, getter of attributes, names of attributes), see fingerprint()."""
+        if cls is type(None) or cls is UndefType:
+            return (self.NONE, None, ())
+        if cls in (list, tuple):
+            return (self.LIST, None, ())
+        if self.compile._get_dispatch(cls, registry)[0] is self.compile._get_dispatch(object, registry)[0]:
+            return (self.VALUE if cls in LEAF_TYPES else self.LEAF, None, ())
+        for c in cls.mro():
+            if c in self.attributes:
+                attrs = tuple(self.attributes[c])
+                if c in self.immutable:
+                    return (self.IMMUTABLE, None, attrs)
+                return self._get_node_kind(attrs, False)
+        attrs = []
+        use_dict = False
+        for c in reversed(cls.mro()):
+            use_dict = use_dict or '__dict__' in c.__dict__
+            slots = c.__dict__.get('__slots__', ())
+            if isinstance(slots, string_types):
+                slots = (slots,)
+            for attr in slots:
+                if attr not in attrs and attr not in self.exclude and attr != '__dict__':
+                    attrs.append(attr)
+        if not attrs and not use_dict:
+            return (self.LEAF, None, ())
+        return self._get_node_kind(tuple(attrs), use_dict)
+
+    def _get_node_kind(self, attrs, use_dict):
+        if use_dict:
+            return (self.DICT_NODE, {}, attrs)
+        if not attrs:
+            return (self.NONE, None, ())
+        if len(attrs) == 1:
+            return (self.NODE1, None, attrs)
+        return (self.NODE, operator.attrgetter(*attrs), attrs)
+
+TemplateCache.attributes.update({
+    NamedCompound: ('operands',),
+    Table: ('_name',),
+    TableAlias: ('_name', '_table'),
+    Field: ('_name', '_prefix'),
+    Name: ('name',),
+})
+TemplateCache.immutable = (Table, Field, Name)
+
+
 def is_list(v):
     return isinstance(v, (list, tuple))
 
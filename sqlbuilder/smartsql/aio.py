@@ -0,0 +1,171 @@
+"""Asynchronous execution of queries by asyncio, Python 3.6+.
+
+Usage:
+
+    result = AsyncResult(SQLiteDriver('db.sqlite3'), compile=sqlite_compile)
+    q = Q(T.author, result=result).fields('*')
+    rows = await q.where(T.author.status == 'active').select()
+    async for row in q.with_timeout(5):
+        ...
+"""
+from __future__ import absolute_import
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from . import Error, Result
+
+__all__ = ('AsyncResult', 'AsyncDriver', 'SQLiteDriver',)
+
+
+class AsyncDriver(object):
+    """Protocol of asynchronous database driver for AsyncResult.
+
+    Cancellation of a coroutine of the driver should cancel the query in database.
+    """
+
+    async def fetch(self, sql, params):
+        """Returns list of rows."""
+        raise NotImplementedError
+
+    async def fetchone(self, sql, params):
+        """Returns the first row, or None."""
+        raise NotImplementedError
+
+    async def execute(self, sql, params):
+        """Executes statement, returns count of affected rows."""
+        raise NotImplementedError
+
+    def iterate(self, sql, params, chunk_size):
+        """Returns asynchronous iterator of lists of rows, with length up to chunk_size."""
+        raise NotImplementedError
+
+
+class AsyncResult(Result):
+    """Asynchronous implementation of Query class.
+
+    Methods of execution return awaitables, rows are streamed by ``async for``.
+    A query is compiled at the moment of call, so the result can be shared by concurrent tasks.
+    """
+
+    timeout = None  # Seconds, for each query, or for each chunk of rows for iteration.
+    chunk_size = 1000  # Count of rows, which are fetched at once by iteration.
+
+    def __init__(self, driver, compile=None, timeout=None, chunk_size=None):
+        Result.__init__(self, compile)
+        self.driver = driver
+        if timeout is not None:
+            self.timeout = timeout
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+    def _wait(self, awaitable):
+        return asyncio.wait_for(awaitable, self.timeout)
+
+    def select(self):
+        return self._wait(self.driver.fetch(*self.compile(self._query)))
+
+    def execute(self):
+        return self._wait(self.driver.execute(*self.compile(self._query)))
+
+    insert = update = delete = execute
+
+    def count(self):
+        return self._count(self._wait(self.driver.fetchone(*self.compile(self._query))))
+
+    @staticmethod
+    async def _count(awaitable):
+        return (await awaitable)[0]
+
+    def with_timeout(self, timeout):
+        """Sets timeout of the query, returns the query. Usage: await q.with_timeout(2.5).select()"""
+        self.timeout = timeout
+        return self._query
+
+    def iterate(self, chunk_size=None):
+        """Returns asynchronous iterator of rows, which are fetched by chunks."""
+        return self._iterate(self.compile(self._query), chunk_size or self.chunk_size, self.timeout)
+
+    async def _iterate(self, compiled, chunk_size, timeout):
+        chunks = self.driver.iterate(compiled[0], compiled[1], chunk_size)
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                except StopAsyncIteration:
+                    return
+                for row in chunk:
+                    yield row
+        finally:
+            await chunks.aclose()
+
+    def __aiter__(self):
+        return self.iterate()
+
+    def __iter__(self):
+        raise Error("Use 'async for' or 'await query.select()' for AsyncResult")
+
+    def __len__(self):
+        raise Error("Use 'await query.count()' for AsyncResult")
+
+
+class SQLiteDriver(AsyncDriver):
+    """Driver for sqlite3, which runs queries in a thread, for local usage and tests.
+
+    Queries are executed one by one, by one connection in autocommit mode.
+    """
+
+    def __init__(self, database, **kwargs):
+        kwargs.setdefault('isolation_level', None)
+        kwargs['check_same_thread'] = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._connection = self._executor.submit(sqlite3.connect, database, **kwargs).result()
+
+    async def _call(self, func, *args):
+        future = self._executor.submit(func, *args)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Not started query is cancelled with the future, running query is interrupted.
+            if future.running():
+                self._connection.interrupt()
+            raise
+
+    def _fetch(self, sql, params, size=None):
+        cursor = self._connection.execute(sql, params)
+        try:
+            return cursor.fetchall() if size is None else cursor.fetchmany(size)
+        finally:
+            cursor.close()
+
+    def _execute(self, sql, params):
+        cursor = self._connection.execute(sql, params)
+        try:
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
+    async def fetch(self, sql, params):
+        return await self._call(self._fetch, sql, params)
+
+    async def fetchone(self, sql, params):
+        rows = await self._call(self._fetch, sql, params, 1)
+        return rows[0] if rows else None
+
+    async def execute(self, sql, params):
+        return await self._call(self._execute, sql, params)
+
+    async def iterate(self, sql, params, chunk_size):
+        cursor = await self._call(self._connection.execute, sql, params)
+        try:
+            while True:
+                rows = await self._call(cursor.fetchmany, chunk_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            self._executor.submit(cursor.close)  # After the running fetch, if any.
+
+    async def close(self):
+        await self._call(self._connection.close)
+        self._executor.shutdown()
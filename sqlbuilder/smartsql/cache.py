@@ -0,0 +1,318 @@
+"""Caching of results of queries, with invalidation by tables.
+
+Usage:
+
+    result = CachedResult(MyResult(), backend=LocMemCache(max_entries=1000), timeout=30)
+    q = Q(T.author, result=result).fields('*')
+    rows = q.where(T.author.status == 'active').select()  # executed
+    rows = q.where(T.author.status == 'active').select()  # from cache
+    q.where(T.author.id == 1).update({'status': 'blocked'})  # invalidates all cached queries on table "author"
+"""
+from __future__ import absolute_import
+import os
+import time
+import uuid
+import errno
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import (
+    Copy, Delete, Expr, Field, Insert, Modify, Name, Result, Table, TableAlias, TableJoin, Update, LEAF_TYPES, string_types
+)
+
+__all__ = ('CachedResult', 'LocMemCache', 'FileCache', 'get_tables', 'get_modified_tables',)
+
+_attr_names = {}
+
+
+def _get_attr_names(cls):
+    try:
+        return _attr_names[cls]
+    except KeyError:
+        names = []
+        for klass in cls.__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, string_types):
+                slots = (slots,)
+            names.extend(name for name in slots if name not in ('__dict__', '__weakref__', '__cached__'))
+        _attr_names[cls] = names
+        return names
+
+
+def get_table_name(table):
+    name = table._name
+    return name.name if isinstance(name, Name) else name
+
+
+def get_tables(expr):
+    """Returns set of names of tables, which the expression depends on, including subqueries."""
+    tables = set()
+    seen = set()
+    stack = [expr]
+    while stack:
+        obj = stack.pop()
+        if obj is None or isinstance(obj, LEAF_TYPES):
+            continue
+        if isinstance(obj, TableAlias):
+            # Alias without table refers to a table, which is given by TableJoin.
+            stack.append(obj._table)
+        elif isinstance(obj, Table):
+            tables.add(get_table_name(obj))
+        elif isinstance(obj, Field):
+            stack.append(obj._prefix)
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, (Expr, TableJoin, Modify)) and id(obj) not in seen:
+            seen.add(id(obj))
+            for name in _get_attr_names(type(obj)):
+                stack.append(getattr(obj, name, None))
+            stack.extend(getattr(obj, '__dict__', {}).values())
+    return tables
+
+
+def get_modified_tables(expr):
+    """Returns set of names of tables, which are modified by the statement."""
+    if isinstance(expr, (Insert, Update, Delete, Copy)):
+        return get_tables(expr.table)
+    return set()
+
+
+class LocMemCache(object):
+    """Thread-safe in-process LRU cache with expiration of entries.
+
+    Values are stored by reference, so they are shared by all readers.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key: (expires, value), the last item is recently used
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.time():
+                return None
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache(object):
+    """LRU cache in files of local directory, which can be shared by processes.
+
+    Each entry is stored in own file by pickle, time of modification of the file is time of last usage.
+    """
+
+    suffix = '.cache'
+
+    def __init__(self, directory, max_entries=1000):
+        self.directory = directory
+        self.max_entries = max_entries
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + self.suffix)
+
+    def _list(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(self.suffix)]
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= time.time():
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.time() + timeout
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+            getattr(os, 'replace', os.rename)(tmp_path, self._get_path(key))  # Readers never see a partial file.
+        except Exception:
+            self._remove(tmp_path)
+            raise
+        self._cull()
+
+    def _cull(self):
+        paths = self._list()
+        if len(paths) <= self.max_entries:
+            return
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        mtimes.sort()
+        for mtime, path in mtimes[:len(mtimes) - self.max_entries]:
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._get_path(key))
+
+    def clear(self):
+        for path in self._list():
+            self._remove(path)
+
+    def __len__(self):
+        return len(self._list())
+
+
+class CachedResult(Result):
+    """Caching layer for other Result.
+
+    Results of select(), count() and iteration are cached by compiled SQL and params.
+    Each entry keeps versions of tables, which the query depends on. Insert, Update, Delete and Copy,
+    executed by this result (or by its clones), change versions of modified tables,
+    so dependent entries are invalidated in all processes, which share the backend.
+    Raw SQL has no known tables, call invalidate() after it.
+    """
+
+    timeout = 60  # Seconds, None means no expiration.
+    version_prefix = 'sqlbuilder:table:'
+
+    def __init__(self, result, backend=None, timeout=None, compile=None):
+        """
+        :param result: Result, which executes queries.
+        :type result: Result
+        :param backend: Storage of entries, LocMemCache by default.
+        """
+        Result.__init__(self, compile or result.compile)
+        self.result = result
+        self.backend = backend if backend is not None else LocMemCache()
+        if timeout is not None:
+            self.timeout = timeout
+
+    def clone(self):
+        c = Result.clone(self)
+        c.result = self.result.clone()  # Backend is shared by clones.
+        return c
+
+    __copy__ = clone
+
+    def _execute(self, method):
+        return getattr(self.result(self._query), method)()
+
+    def _fetch(self):
+        return list(iter(self.result(self._query)))
+
+    def _get_key(self, method):
+        sql, params = self.compile(self._query)
+        params = tuple(sorted(params.items())) if isinstance(params, dict) else tuple(params)
+        return hashlib.sha1(repr((method, sql, params)).encode('utf-8')).hexdigest()
+
+    def _get_versions(self, tables, create=False):
+        versions = []
+        for table in tables:
+            key = self.version_prefix + table
+            version = self.backend.get(key)
+            if version is None:
+                if not create:
+                    return None  # Version could be evicted after invalidation.
+                version = uuid.uuid4().hex
+                self.backend.set(key, version)
+            versions.append(version)
+        return versions
+
+    def _cached(self, method, fetch):
+        key = self._get_key(method)
+        entry = self.backend.get(key)
+        if entry is not None:
+            tables, versions, value = entry
+            if self._get_versions(tables) == versions:
+                return value
+        tables = sorted(get_tables(self._query))
+        versions = self._get_versions(tables, create=True)  # Before execution, to not miss concurrent changes.
+        value = fetch()
+        self.backend.set(key, (tables, versions, value), self.timeout)
+        return value
+
+    def invalidate(self, *tables):
+        """Invalidates cached results of queries, which depend on given tables (names or Table instances)."""
+        for table in tables:
+            if isinstance(table, Table):
+                table = get_table_name(table)
+            self.backend.delete(self.version_prefix + table)
+
+    def clear(self):
+        self.backend.clear()
+
+    def _modify(self, method):
+        try:
+            return self._execute(method)
+        finally:
+            self.invalidate(*get_modified_tables(self._query))
+
+    def select(self):
+        return list(self._cached('select', lambda: list(self._execute('select'))))
+
+    def count(self):
+        return self._cached('count', lambda: self._execute('count'))
+
+    def execute(self):
+        return self._modify('execute')
+
+    def insert(self):
+        return self._modify('insert')
+
+    def update(self):
+        return self._modify('update')
+
+    def delete(self):
+        return self._modify('delete')
+
+    def __iter__(self):
+        return iter(self._cached('iter', self._fetch))
+
+    def __len__(self):
+        return len(self._cached('iter', self._fetch))
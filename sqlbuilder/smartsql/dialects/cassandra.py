@@ -1,4 +1,4 @@
-from .. import compile as parent_compile, Name, Field, Value, ValueCompiler
+from .. import compile as parent_compile, Name, Field, Value, ValueCompiler, iterative
 
 try:
     str = unicode  # Python 2.* compatible
@@ -13,8 +13,9 @@ compile = parent_compile.create_child()
 
 
 @compile.when(Field)
+@iterative
 def compile_field(compile, expr, state):
-    compile(expr.name, state)
+    yield expr._name
 
 
 compile_value = ValueCompiler(escape_delimiter="\\")
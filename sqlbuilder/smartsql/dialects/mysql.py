@@ -1,6 +1,6 @@
 from .. import (
-    compile as parent_compile, SPACE, Binary, Concat, ExprList, Insert, Name,
-    NameCompiler, Parentheses, Query, Value, ValueCompiler
+    compile as parent_compile, SPACE, Binary, Concat, Insert, Name,
+    NameCompiler, Parentheses, Query, Value, ValueCompiler, cached_compile, iterate_values, iterative
 )
 
 try:
@@ -13,6 +13,7 @@ except NameError:
     integer_types = (int,)
 
 compile = parent_compile.create_child()
+compile.max_params = 65535  # Limit of placeholders of prepared statement.
 
 TRANSLATION_MAP = {
     'LIKE': 'LIKE BINARY',
@@ -20,22 +21,24 @@ TRANSLATION_MAP = {
 }
 
 compile_name = NameCompiler(delimiter='`', escape_delimiter='`', max_length=64)
-compile.when(Name)(compile_name)
+compile.when(Name)(cached_compile(compile_name))
 
 compile_value = ValueCompiler(escape_delimiter="\\")
 compile.when(Value)(compile_value)
 
 
 @compile.when(Binary)
+@iterative
 def compile_condition(compile, expr, state):
-    compile(expr.left, state)
+    yield expr.left
     state.sql.append(SPACE)
     state.sql.append(TRANSLATION_MAP.get(expr.sql, expr.sql))
     state.sql.append(SPACE)
-    compile(expr.right, state)
+    yield expr.right
 
 
 @compile.when(Concat)
+@iterative
 def compile_concat(compile, expr, state):
     if not expr.ws():
         state.sql.append('CONCAT(')
@@ -45,40 +48,42 @@ def compile_concat(compile, expr, state):
                 first = False
             else:
                 state.sql.append(', ')
-            compile(a, state)
+            yield a
         state.sql.append(')')
     else:
         state.sql.append('CONCAT_WS(')
-        compile(expr.ws(), state)
+        yield expr.ws()
         for a in expr:
             state.sql.append(expr.sql)
-            compile(a, state)
+            yield a
         state.sql.append(')')
 
 
 @compile.when(Insert)
+@iterative
 def compile_insert(compile, expr, state):
     state.sql.append("INSERT ")
-    if expr._ignore:
+    if expr.ignore:
         state.sql.append("IGNORE ")
     state.sql.append("INTO ")
-    compile(expr._table, state)
+    yield expr.table
     state.sql.append(SPACE)
-    compile(Parentheses(expr._fields), state)
-    if isinstance(expr._values, Query):
+    yield Parentheses(expr.fields)
+    if isinstance(expr.values, Query):
         state.sql.append(SPACE)
-        compile(expr._values, state)
+        yield expr.values
     else:
         state.sql.append(" VALUES ")
-        compile(ExprList(*expr._values).join(', '), state)
-    if expr._on_duplicate_key_update:
+        for child in iterate_values(compile, expr.values, state):
+            yield child
+    if expr.on_duplicate_key_update:
         state.sql.append(" ON DUPLICATE KEY UPDATE ")
         first = True
-        for f, v in expr._on_duplicate_key_update:
+        for f, v in expr.on_duplicate_key_update:
             if first:
                 first = False
             else:
                 state.sql.append(", ")
-            compile(f, state)
+            yield f
             state.sql.append(" = ")
-            compile(v, state)
+            yield v
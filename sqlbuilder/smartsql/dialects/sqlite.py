@@ -1,6 +1,14 @@
-from .. import compile as parent_compile, SPACE, Name, NameCompiler, Binary
+from .. import compile as parent_compile, SPACE, Name, NameCompiler, Binary, cached_compile, iterative
+
+try:
+    from sqlite3 import sqlite_version_info
+except ImportError:
+    sqlite_version_info = (0, 0, 0)
 
 compile = parent_compile.create_child()
+compile.paramstyle = 'qmark'
+# SQLITE_MAX_VARIABLE_NUMBER, it was increased in 3.32.0.
+compile.max_params = 32766 if sqlite_version_info >= (3, 32, 0) else 999
 
 TRANSLATION_MAP = {
     'LIKE': 'GLOB',
@@ -8,20 +16,15 @@ TRANSLATION_MAP = {
 }
 
 
-@compile.when(object)
-def compile_object(compile, expr, state):
-    state.sql.append('?')
-    state.params.append(expr)
-
-
 compile_name = NameCompiler(delimiter='`', escape_delimiter='`')
-compile.when(Name)(compile_name)
+compile.when(Name)(cached_compile(compile_name))
 
 
 @compile.when(Binary)
+@iterative
 def compile_condition(compile, expr, state):
-    compile(expr.left, state)
+    yield expr.left
     state.sql.append(SPACE)
     state.sql.append(TRANSLATION_MAP.get(expr.sql, expr.sql))
     state.sql.append(SPACE)
-    compile(expr.right, state)
+    yield expr.right
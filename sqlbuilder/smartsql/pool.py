@@ -0,0 +1,255 @@
+"""Execution of queries by DB-API 2.0 drivers with pool of connections.
+
+Usage:
+
+    pool = ConnectionPool(lambda: psycopg2.connect(dsn), max_size=10, timeout=5, max_lifetime=3600, health_check=ping)
+    result = PooledResult(pool)
+    q = Q(T.author, result=result).fields('*')
+    rows = q.where(T.author.status == 'active').select()
+    result(Insert(T.author, map={'name': P(name='name')})).executemany([{'name': 'John'}, {'name': 'Tom'}])
+"""
+from __future__ import absolute_import
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from . import Error, PreparedQuery, Result, default_timer
+
+__all__ = ('ConnectionPool', 'PooledResult', 'PoolTimeout', 'ping',)
+
+
+class PoolTimeout(Error):
+    pass
+
+
+def ping(connection):
+    """Health check, which executes trivial query."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+class ConnectionPool(object):
+    """Bounded thread-safe pool of DB-API connections.
+
+    Connections are created on demand by factory, up to max_size.
+    Checkout waits for a returned connection up to timeout seconds, and raises PoolTimeout after.
+    Connections older than max_lifetime seconds are recycled, idle connections are checked by health_check
+    (a callable, which raises an exception or returns False for broken connection) before checkout.
+    """
+
+    timer = default_timer
+
+    def __init__(self, factory, max_size=10, timeout=30, max_lifetime=None, health_check=None):
+        self.factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self._idle = deque()  # (connection, created), the last is returned recently
+        self._size = 0  # count of open and creating connections
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.created = 0  # Count of created connections.
+        self.closed = 0  # Count of closed connections, because of recycling, failed health checks or errors.
+        self.checkouts = 0
+        self.waits = 0  # Count of checkouts, which waited for a connection.
+        self.wait_time = 0.0  # Total time of waiting, in seconds.
+        self.timeouts = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @property
+    def in_use(self):
+        return self._size - len(self._idle)
+
+    def stats(self):
+        """Returns metrics of the pool as dict."""
+        with self._condition:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'created': self.created,
+                'closed': self.closed,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+            }
+
+    def _is_expired(self, created):
+        return self.max_lifetime is not None and self.timer() - created >= self.max_lifetime
+
+    def _is_healthy(self, connection):
+        if self.health_check is None:
+            return True
+        try:
+            return self.health_check(connection) is not False
+        except Exception:
+            return False
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def checkout(self, timeout=None):
+        """Returns pair (connection, created), the connection should be returned by checkin()."""
+        timeout = self.timeout if timeout is None else timeout
+        start = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise Error("Pool is closed")
+                if self._idle:
+                    connection, created = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    connection = None
+                    self._size += 1  # Reserve a place for the new connection.
+                    break
+                now = self.timer()
+                if start is None:
+                    start = now
+                    self.waits += 1
+                remaining = start + timeout - now if timeout is not None else None
+                if remaining is not None and remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time += now - start
+                    raise PoolTimeout("Timeout of waiting for connection, {0} connections in use".format(self._size))
+                self._condition.wait(remaining)
+            if start is not None:
+                self.wait_time += self.timer() - start
+            self.checkouts += 1
+
+        if connection is not None and (self._is_expired(created) or not self._is_healthy(connection)):
+            self._close(connection)
+            with self._condition:
+                self.closed += 1
+            connection = None
+        if connection is None:
+            try:
+                connection, created = self.factory(), self.timer()
+            except Exception:
+                self._release()
+                raise
+            with self._condition:
+                self.created += 1
+        return connection, created
+
+    def checkin(self, connection, created, discard=False):
+        """Returns the connection to the pool, or closes it, if discard is True or it's expired."""
+        with self._condition:
+            if not (discard or self._closed or self._is_expired(created)):
+                self._idle.append((connection, created))
+                self._condition.notify()
+                return
+        self._close(connection)
+        with self._condition:
+            self.closed += 1
+        self._release()
+
+    def _release(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager of transaction, commits on success, rolls back on error."""
+        connection, created = self.checkout(timeout)
+        success = False
+        try:
+            yield connection
+            connection.commit()
+            success = True
+        finally:
+            discard = False
+            if not success:
+                try:
+                    connection.rollback()
+                except Exception:
+                    discard = True  # Broken connection, the original exception is raised.
+            self.checkin(connection, created, discard)
+
+    def close(self):
+        """Closes idle connections, connections in use are closed on checkin."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            self.closed += len(idle)
+            self._condition.notify_all()
+        for connection, created in idle:
+            self._close(connection)
+
+
+class PooledResult(Result):
+    """Implementation of Query class, which executes queries by connections of ConnectionPool.
+
+    Each call is executed in own transaction.
+    The instance can be shared by threads, since each query is bound to own clone of it.
+    """
+
+    def __init__(self, pool, compile=None):
+        Result.__init__(self, compile)
+        self.pool = pool
+
+    def __call__(self, query):
+        c = self.clone()  # Not self, concurrent threads would overwrite the query of each other.
+        c._query = query
+        return c
+
+    def _execute(self, fetch, sql, params):
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                return fetch(cursor)
+            finally:
+                cursor.close()
+
+    def select(self):
+        return self._execute(lambda cursor: cursor.fetchall(), *self.compile(self._query))
+
+    def count(self):
+        return self._execute(lambda cursor: cursor.fetchone()[0], *self.compile(self._query))
+
+    def execute(self):
+        """Executes statement, returns count of affected rows."""
+        return self._execute(lambda cursor: cursor.rowcount, *self.compile(self._query))
+
+    insert = update = delete = execute
+
+    def executemany(self, values):
+        """Executes statement with unbound params (see Param) for each dict of values, returns count of affected rows."""
+        prepared = PreparedQuery(self._query, self.compile)
+        params = [prepared(**v)[1] for v in values]
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.executemany(prepared.sql, params)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    def __iter__(self):
+        return iter(self.select())
+
+    def __len__(self):
+        return len(self.select())
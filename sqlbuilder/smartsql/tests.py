@@ -1,16 +1,29 @@
 from __future__ import absolute_import
+import sys
 import datetime
 import operator
 import unittest
 from collections import OrderedDict
+from functools import reduce
 
 from sqlbuilder.smartsql import (
     PLACEHOLDER, Q, T, Table, TA, F, Field, A, E, P, Not, func, const, CompositeExpr,
-    Case, Cast, FieldList, ExprList, Result, TableJoin, compile
+    Case, Cast, FieldList, ExprList, Result, TableJoin, Parentheses, Add, Select, State, Insert, Update, Delete, Error, Name, compile
 )
+from sqlbuilder.smartsql.dialects.cassandra import compile as cassandra_compile
 from sqlbuilder.smartsql.dialects.mysql import compile as mysql_compile
 
-__all__ = ('TestTable', 'TestField', 'TestExpr', 'TestCaseExpr', 'TestCallable', 'TestCompositeExpr', 'TestQuery', 'TestResult', 'TestSmartSQLLegacy',)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from sqlbuilder.smartsql import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+__all__ = ('TestTable', 'TestField', 'TestExpr', 'TestCaseExpr', 'TestCallable', 'TestCompositeExpr', 'TestQuery', 'TestResult', 'TestCompiler', 'TestTemplateCache', 'TestPreparedQuery', 'TestInsertChunks', 'TestCopy', 'TestCachedResult', 'TestPooledResult', 'TestAsyncResult', 'TestSmartSQLLegacy',)
 
 
 class TestCase(unittest.TestCase):
@@ -219,6 +232,12 @@ class TestField(TestCase):
             ('SELECT "book"."id", "book"."status" AS "a" FROM "book" WHERE "a" IN (%s, %s)', ['new', 'approved'])
         )
 
+        # Cassandra has no table prefixes
+        self.assertEqual(
+            cassandra_compile(Q(T.book).fields(T.book.id, T.book.title).where(T.book.author_id == 1)),
+            ('SELECT "id", "title" FROM "book" WHERE "author_id" = %s', [1])
+        )
+
 
 class TestExpr(TestCase):
 
@@ -1037,6 +1056,19 @@ class TestQuery(TestCase):
             ('SELECT "author"."id", (SELECT COUNT("book"."id") FROM "book" WHERE "book"."pub_date" > %s AND "book"."author_id" = "author"."id" GROUP BY "book"."author_id") AS "book_count" FROM "author" WHERE "author"."status" = %s ORDER BY "book_count" DESC', ['2015-01-01', 'active'])
         )
 
+    def test_clone(self):
+        q = Q().fields(T.author.id).tables(T.author).where(T.author.status == 'active').order_by(T.author.id)
+        c = q.clone()
+        self.assertIsNot(c, q)
+        self.assertIs(c._where, q._where)
+        self.assertIs(c._fields, q._fields)
+
+        sql = compile(q)
+        q.tables((q.tables() + T.book).on(T.book.author_id == T.author.id)).fields(T.book.title).where(T.book.pub_date > '2015-01-01').order_by(T.book.id, reset=True)
+        q.tables(T.author).on(T.author.id == 1)
+        q.group_by(T.author.id).having(T.author.id > 1).limit(10)
+        self.assertEqual(compile(q), sql)
+
 
 class TestResult(TestCase):
 
@@ -1067,6 +1099,1137 @@ class TestResult(TestCase):
         self.assertEqual(q3.select(), ('SELECT `author`.`id`, `author`.`name` FROM `author` WHERE `author`.`name` = %s', ['John']))
 
 
+class TestCompiler(TestCase):
+
+    def test_dispatch_cache(self):
+        parent = compile.create_child()
+        child = parent.create_child()
+        self.assertEqual(child(T.author.id == 5), ('"author"."id" = %s', [5]))
+        self.assertEqual(child(Parentheses(5)), ('(%s)', [5]))
+
+        @parent.when(int)
+        def compile_int(compile, expr, state):
+            state.sql.append(str(expr))
+
+        self.assertEqual(child(T.author.id == 5), ('"author"."id" = 5', []))
+        self.assertEqual(compile(T.author.id == 5), ('"author"."id" = %s', [5]))
+
+        @child.when(Field)
+        def compile_field(compile, expr, state):
+            compile(expr._name, state)
+
+        self.assertEqual(child(T.author.id == 5), ('"id" = 5', []))
+        self.assertEqual(parent(T.author.id == 5), ('"author"."id" = 5', []))
+
+    def test_precedence_table(self):
+        child = compile.create_child()
+        expr = (T.author.a + T.author.b) * T.author.c
+        self.assertEqual(child(expr), ('("author"."a" + "author"."b") * "author"."c"', []))
+        self.assertEqual(child(T.author.a.op('#')(1) * 2), ('("author"."a" # %s) * %s', [1, 2]))
+        child.set_precedence(230, '#')
+        self.assertEqual(child(T.author.a.op('#')(1) * 2), ('"author"."a" # %s * %s', [1, 2]))
+        child.set_precedence(220, Add)
+        self.assertEqual(child(expr), ('"author"."a" + "author"."b" * "author"."c"', []))
+        self.assertEqual(compile(expr), ('("author"."a" + "author"."b") * "author"."c"', []))
+
+        size = len(child._registry.precedence_table)
+        for i in range(100):
+            child(Q(T.author).fields((T.author.a + i).as_('a{0}'.format(i))))
+        self.assertLess(len(child._registry.precedence_table), size + 10)  # Non-string sql is not memoized.
+
+    def test_state_callers(self):
+        state = State()
+        state.callers.append(Select)
+        state.callers.append(FieldList)
+        state.callers.append(A)
+        self.assertIs(state.callers[0], A)
+        self.assertIs(state.callers[1], FieldList)
+        self.assertEqual(list(state.callers), [A, FieldList, Select])
+        self.assertEqual(state.callers[1:], [FieldList, Select])
+        self.assertRaises(IndexError, lambda: state.callers[3])
+        state.callers.pop()
+        self.assertIs(state.callers[0], FieldList)
+
+        q = Q(T.author).fields(T.author.id.as_('author_id'))
+        for i in range(100):
+            q = Q(q.as_table('t{0}'.format(i))).fields(T.author.id.as_('author_id'))
+        sql, params = compile(q)
+        self.assertEqual(sql.count(' AS "author_id"'), 101)
+
+    def test_deep_expression(self):
+        n = sys.getrecursionlimit() * 10
+        cond = reduce(operator.and_, (T.author.id == i for i in range(n)))
+        sql, params = compile(Q(T.author).fields('*').where(cond))
+        self.assertEqual(sql, 'SELECT * FROM "author" WHERE ' + ' AND '.join(['"author"."id" = %s'] * n))
+        self.assertEqual(params, list(range(n)))
+
+        cond = reduce(operator.or_, (T.author.id == i for i in range(n)))
+        sql, params = mysql_compile(cond & (T.author.status == 'active'))
+        self.assertEqual(sql, '(' + ' OR '.join(['`author`.`id` = %s'] * n) + ') AND `author`.`status` = %s')
+
+        sql, params = compile(CompositeExpr(T.author.first_name, T.author.last_name).in_(
+            [('John{0}'.format(i), 'Smith') for i in range(n)]
+        ))
+        self.assertEqual(sql, ' OR '.join(['"author"."first_name" = %s AND "author"."last_name" = %s'] * n))
+
+        self.assertEqual(compile.template_cache(cond), compile(cond))
+
+        q = Q(T.author).fields(T.author.id)
+        for i in range(sys.getrecursionlimit()):
+            q = Q(T.author).fields(T.author.id).where(T.author.id.in_(q))
+        sql, params = compile(q)
+        self.assertEqual(sql.count('SELECT'), sys.getrecursionlimit() + 1)
+
+    def test_cached_compile(self):
+        from sqlbuilder.smartsql import Expr, cached_compile, iterative
+
+        class Point(Expr):
+            __slots__ = ('x', 'y', '__cached__')
+
+            def __init__(self, x, y):
+                Expr.__init__(self, 'POINT')
+                self.x, self.y = x, y
+                self.__cached__ = {}
+
+        calls = []
+
+        @compile.when(Point)
+        @cached_compile
+        @iterative
+        def compile_point(compile, expr, state):
+            calls.append(expr)
+            state.sql.append('POINT(')
+            yield expr.x
+            state.sql.append(', ')
+            yield expr.y
+            state.sql.append(')')
+
+        try:
+            author = T.author
+            p = Point(author.x, 1)
+            q = Q(T.book).fields(T.book.id).where(T.book.location == p)
+            for i in range(2):
+                self.assertEqual(compile(q), (
+                    'SELECT "book"."id" FROM "book" WHERE "book"."location" = POINT("author"."x", %s)', [1]
+                ))
+                state = State()
+                compile(p, state)
+                self.assertEqual(state.auto_tables, [author])
+            self.assertEqual(len(calls), 2)  # Once per caller.
+            self.assertEqual(mysql_compile(p), ('POINT(`author`.`x`, %s)', [1]))
+            self.assertEqual(len(calls), 3)
+
+            # Changes of registry replace cached entries instead of adding new ones.
+            size = len(p.__cached__)
+            for i in range(10):
+                compile.set_precedence(compile._registry.precedence.get(Point, 0), Point)
+                self.assertEqual(compile(p), ('POINT("author"."x", %s)', [1]))
+            self.assertEqual(len(calls), 13)
+            self.assertEqual(len(p.__cached__), size)
+        finally:
+            del compile._local_registry[Point]
+            compile._local_precedence.pop(Point, None)
+            compile._update_cache()
+
+        ta = T.author.as_('a')
+        q = Q().tables(T.book & ta).fields(ta.id, ta.name.as_('n'))
+        for i in range(2):
+            self.assertEqual(compile(q)[0], 'SELECT "a"."id", "a"."name" AS "n" FROM "book" INNER JOIN "author" AS "a"')
+
+        # Alias and TableAlias can hold mutable expressions, so they are not cached.
+        a = ExprList(T.author.first_name).as_('n')
+        q = Q(T.author).fields(a)
+        self.assertEqual(compile(q)[0], 'SELECT "author"."first_name" AS "n" FROM "author"')
+        a.expr.append(T.author.last_name)
+        self.assertEqual(compile(q)[0], 'SELECT "author"."first_name" "author"."last_name" AS "n" FROM "author"')
+
+    def test_name_compiler(self):
+        from sqlbuilder.smartsql import Name, NameCompiler
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        for i in range(2):
+            self.assertEqual(compile(Name('a"b')), ('"a""b"', []))
+            self.assertEqual(mysql_compile(Name('a`b"')), ('`a``b"`', []))
+            self.assertEqual(sqlite_compile(Name('a`b')), ('`a``b`', []))
+            name = Name('n' * 64)
+            self.assertRaises(NameCompiler.MaxLengthError, compile, name)
+            self.assertEqual(mysql_compile(name)[0], '`{0}`'.format('n' * 64))
+            self.assertRaises(NameCompiler.MaxLengthError, mysql_compile, Name('n' * 65))
+
+        compile_name = NameCompiler(cache_size=2)
+        for i in range(5):
+            state = State()
+            compile_name(compile, Name('name{0}'.format(i)), state)
+            self.assertEqual(state.sql, ['"name{0}"'.format(i)])
+            self.assertLessEqual(len(compile_name._cache), 2)
+
+    def test_value_compiler(self):
+        from sqlbuilder.smartsql import Value, ValueCompiler
+        from sqlbuilder.smartsql.dialects.cassandra import compile as cassandra_compile
+        for i in range(2):
+            self.assertEqual(compile(Value("it's 50%\n")), ("'it''s 50%%\\n'", []))
+            self.assertEqual(mysql_compile(Value("it's\\")), ("'it\\\\'s\\\\'", []))
+            self.assertEqual(cassandra_compile(Value("it's")), ("'it\\\\'s'", []))
+            self.assertEqual(compile(Value(5)), ("'5'", []))
+        long_value = "it's" * 100
+        self.assertEqual(compile(Value(long_value))[0], "'{0}'".format("it''s" * 100))
+
+        compile_value = ValueCompiler(cache_size=2)
+        for i in range(5):
+            state = State()
+            compile_value(compile, Value('value{0}'.format(i)), state)
+            self.assertEqual(state.sql, ["'value{0}'".format(i)])
+            self.assertLessEqual(len(compile_value._cache), 2)
+        compile_value(compile, Value(long_value), State())
+        self.assertNotIn(long_value, compile_value._cache)
+
+    def test_write(self):
+
+        class Writer(list):
+            write = list.append
+
+        n = State.buffer_size
+        rows = [('name{0}'.format(i), i) for i in range(n)]
+        expected = compile(Insert(T.author, fields=('name', 'age'), values=rows))
+        writer = Writer()
+        params = compile.write(Insert(T.author, fields=('name', 'age'), values=iter(rows)), writer)
+        self.assertEqual((''.join(writer), params), expected)
+        self.assertGreater(len(writer), 1)
+        self.assertLessEqual(max(len(i) for i in writer), len(expected[0]) // 2)
+
+        params = []
+        q = Q(T.author).fields('*').where(T.author.id.in_(list(range(n))))
+        writer = Writer()
+        self.assertIs(compile.write(q, writer, params), params)
+        self.assertEqual((''.join(writer), params), compile(q))
+        self.assertEqual(len(writer), 1)
+
+    def test_flat_compound(self):
+        a, b, c, d = T.author.a, T.author.b, T.author.c, T.author.d
+        cond = (a == 1) & (b == 2) & (c == 3)
+        self.assertEqual(len(cond.operands), 3)
+        self.assertIs(cond.right.__class__, (c == 3).__class__)
+        self.assertEqual(compile(cond.left), ('"author"."a" = %s AND "author"."b" = %s', [1, 2]))
+
+        # Right operand of the same type is flattened too, output is the same.
+        self.assertEqual(len(((a == 1) & ((b == 2) & (c == 3))).operands), 3)
+        self.assertEqual(compile(a + (b + c)), ('"author"."a" + "author"."b" + "author"."c"', []))
+        self.assertEqual(compile((a + b) * c), ('("author"."a" + "author"."b") * "author"."c"', []))
+        self.assertEqual(compile(a | b & c | d), ('"author"."a" OR "author"."b" AND "author"."c" OR "author"."d"', []))
+
+        # Branching of shared operands list.
+        base = (a == 1) & (b == 2)
+        first = base & (c == 3)
+        second = base & (d == 4)
+        third = first & (d == 4)
+        self.assertEqual(compile(base), ('"author"."a" = %s AND "author"."b" = %s', [1, 2]))
+        self.assertEqual(compile(first), ('"author"."a" = %s AND "author"."b" = %s AND "author"."c" = %s', [1, 2, 3]))
+        self.assertEqual(compile(second), ('"author"."a" = %s AND "author"."b" = %s AND "author"."d" = %s', [1, 2, 4]))
+        self.assertEqual(compile(third), (
+            '"author"."a" = %s AND "author"."b" = %s AND "author"."c" = %s AND "author"."d" = %s', [1, 2, 3, 4]
+        ))
+
+        q = Q(T.author).fields('*').where(a == 1)
+        q1, q2 = q.where(b == 2), q.where(c == 3)
+        self.assertEqual(compile(q1)[1], [1, 2])
+        self.assertEqual(compile(q2)[1], [1, 3])
+        self.assertEqual(compile(q)[1], [1])
+
+    def test_profile(self):
+        child = compile.create_child()
+        q = Q(T.author).fields(T.author.id).where((T.author.id == 1) & ((T.author.a == 2) | (T.author.b == 3)))
+        expected = compile(q)
+        handler = compile.get_handler(Field)
+        state = State()
+        with compile.profile() as profiler:
+            child(q, state)
+            self.assertIsNot(child.get_handler(Field), handler)
+        self.assertIs(child.get_handler(Field), handler)
+        self.assertEqual((''.join(state.sql), state.params), expected)
+
+        stats = profiler.stats
+        self.assertEqual(stats['compile_query'].calls, 1)
+        self.assertEqual(stats['compile_field'].calls, 4)
+        self.assertEqual(stats['compile_namedcompound'].calls, 2)
+        self.assertEqual(stats['compile_query'].fragments, len(state.sql))
+        self.assertGreaterEqual(stats['compile_query'].cumtime, stats['compile_namedcompound'].cumtime)
+        self.assertLessEqual(stats['compile_query'].selftime, stats['compile_query'].cumtime)
+        self.assertGreater(profiler.max_depth, 3)
+        self.assertEqual(profiler.get_stats()[0].name, 'compile_query')
+        self.assertEqual(profiler.get_stats('calls')[0].name, 'NameCompiler')
+        self.assertIn('compile_query', profiler.report(limit=3))
+
+        # Own profiler of child compiler, and names of dialect handlers
+        with mysql_compile.profile() as profiler:
+            with compile.profile() as parent_profiler:
+                mysql_compile(q)
+        self.assertIn('mysql.compile_condition', profiler.stats)
+        self.assertEqual(parent_profiler.stats, {})
+
+    def test_threads(self):
+        import threading
+        parent = compile.create_child()
+        child = parent.create_child()
+        q = Q(T.author).fields(T.author.id, T.author.name).where((T.author.id + 1) * 2 > 5)
+        expected = compile(q)
+        handler = parent.get_handler(Field)
+        registry = child._registry
+        stop, errors = threading.Event(), []
+
+        def run():
+            try:
+                while not stop.is_set():
+                    self.assertEqual(child(q), expected)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(50):
+            parent.when(Field)(handler)
+            parent.set_precedence(210, Add)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIsNot(child._registry, registry)  # Registry is replaced, not changed.
+        self.assertEqual(registry.handlers, child._registry.handlers)
+
+    def test_hooks(self):
+        parent = compile.create_child()
+        child = parent.create_child()
+        events = []
+        hook = parent.add_hook(events.append)
+
+        q = Q(T.author).fields('*').where(T.author.id.in_([1, 2, 3]))
+        self.assertEqual(child(q), compile(q))
+        event = events.pop()
+        self.assertIs(event.compiler, child)
+        self.assertIs(event.expr, q)
+        self.assertEqual(event.statement, 'Select')
+        self.assertEqual((event.sql, event.params), compile(q))
+        self.assertEqual(event.sql_length, len(event.sql))
+        self.assertEqual(event.param_count, 3)
+        self.assertGreaterEqual(event.duration, 0)
+        self.assertEqual(event.normalized_sql, 'SELECT * FROM "author" WHERE "author"."id" IN (%s, ...)')
+
+        child(Q(T.author).fields('*').where(T.author.id.in_([4, 5])))
+        self.assertEqual(events.pop().fingerprint, event.fingerprint)
+        child(Q(T.author).fields('*').where(T.author.name.in_([4, 5])))
+        self.assertNotEqual(events.pop().fingerprint, event.fingerprint)
+
+        # Nested expressions and templates of rows are not reported.
+        child(Insert(T.author, fields=('id', 'name'), values=[(1, 'a'), (2, 'b')]))
+        event = events.pop()
+        self.assertEqual(events, [])
+        self.assertEqual(event.statement, 'Insert')
+        self.assertEqual(event.normalized_sql, 'INSERT INTO "author" ("id", "name") VALUES (%s, ...), ...')
+
+        for expr, statement in ((Q(T.author).as_set() | Q(T.book), 'Set'),
+                                (Q().raw('SELECT 1'), 'Raw'),
+                                (Update(T.author, map={'name': 'a'}), 'Update'),
+                                (Delete(T.author), 'Delete'),
+                                (T.author.id + 1, 'Add')):
+            child(expr)
+            self.assertEqual(events.pop().statement, statement)
+
+        # Hits of template cache are reported too.
+        child.template_cache(q)
+        child.template_cache(q)
+        self.assertEqual(child.template_cache.hits, 1)
+        self.assertEqual(len(events), 2)
+
+        # Each statement of InsertChunks, of PreparedQuery and of write() is reported.
+        del events[:]
+        insert = Insert(T.author, fields=('id', 'name'), values=[(i, 'a') for i in range(6)])
+        chunks = list(insert.chunks(child, max_params=4))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual([(e.sql, e.params) for e in events], chunks)
+        self.assertEqual(set(e.expr for e in events), {insert})
+        self.assertEqual(len(set(e.fingerprint for e in events)), 1)
+
+        del events[:]
+        prepared = Q(T.author, result=Result(compile=child)).fields('*').where(T.author.id == P(name='id')).prepare()
+        self.assertEqual(prepared(id=1), ('SELECT * FROM "author" WHERE "author"."id" = %s', [1]))
+        self.assertEqual(prepared(id=2), ('SELECT * FROM "author" WHERE "author"."id" = %s', [2]))
+        self.assertEqual([(e.sql, e.params) for e in events], [(prepared.sql, [1]), (prepared.sql, [2])])
+
+        class Writer(list):
+            write = list.append
+
+        del events[:]
+        writer = Writer()
+        insert = Insert(T.author, fields=('id', 'name'), values=[(i, 'a') for i in range(State.buffer_size * 2)])
+        params = child.write(insert, writer)
+        event = events.pop()
+        self.assertEqual((event.expr, event.params, event.statement), (insert, params, 'Insert'))
+        self.assertEqual(event.sql_length, len(''.join(writer)))
+        self.assertLess(len(event.sql), event.sql_length)
+        self.assertTrue(''.join(writer).startswith(event.sql))
+        self.assertEqual(event.normalized_sql, 'INSERT INTO "author" ("id", "name") VALUES (%s, ...), ...')
+
+        parent.remove_hook(hook)
+        child(q)
+        self.assertEqual(events, [])
+
+    def test_paramstyle(self):
+        from sqlbuilder.smartsql import PreparedQuery, Value
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        self.assertEqual(compile.paramstyle, 'format')
+        self.assertEqual(sqlite_compile.paramstyle, 'qmark')
+        self.assertEqual(sqlite_compile.create_child().paramstyle, 'qmark')
+
+        c = compile.create_child()
+        self.assertRaises(Error, setattr, c, 'paramstyle', 'unknown')
+        q = Q(T.author).fields(T.author.id).where(
+            (T.author.name.like('50%')) & T.author.id.in_([1, 2]) & E('"author"."status" <> %s', 'deleted')
+        )
+        result = OrderedDict((
+            ('format', 'SELECT "author"."id" FROM "author" WHERE "author"."name" LIKE %s AND "author"."id" IN (%s, %s) AND ("author"."status" <> %s)'),
+            ('numeric', 'SELECT "author"."id" FROM "author" WHERE "author"."name" LIKE :1 AND "author"."id" IN (:2, :3) AND ("author"."status" <> :4)'),
+            ('dollar', 'SELECT "author"."id" FROM "author" WHERE "author"."name" LIKE $1 AND "author"."id" IN ($2, $3) AND ("author"."status" <> $4)'),
+            ('named', 'SELECT "author"."id" FROM "author" WHERE "author"."name" LIKE :p1 AND "author"."id" IN (:p2, :p3) AND ("author"."status" <> :p4)'),
+            ('pyformat', 'SELECT "author"."id" FROM "author" WHERE "author"."name" LIKE %(p1)s AND "author"."id" IN (%(p2)s, %(p3)s) AND ("author"."status" <> %(p4)s)'),
+        ))  # The last paramstyle is named, it's used below.
+        params = ['50%', 1, 2, 'deleted']
+        named_params = {'p1': '50%', 'p2': 1, 'p3': 2, 'p4': 'deleted'}
+        for paramstyle, sql in result.items():
+            c.paramstyle = paramstyle
+            expected = (sql, named_params if paramstyle in ('named', 'pyformat') else params)
+            for i in range(2):
+                self.assertEqual(c(q), expected)
+                self.assertEqual(c.template_cache(q), expected)
+        self.assertEqual(c.template_cache.hits, len(result))  # The cache is cleared by change of paramstyle.
+
+        # Percent sign is escaped only for format and pyformat.
+        self.assertEqual(c(Value('50%') + T.a.b), ('\'50%%\' + "a"."b"', {}))
+        self.assertEqual(c(Name('50%')), ('"50%%"', {}))
+        c.paramstyle = 'dollar'
+        self.assertEqual(c(Value('50%') + T.a.b), ('\'50%\' + "a"."b"', []))
+        self.assertEqual(c(Name('50%')), ('"50%"', []))
+
+        # Paramstyle is published with snapshot of registry, compiling keeps paramstyle of its snapshot.
+        registry = c._registry
+        c.paramstyle = 'format'
+        self.assertEqual((registry.paramstyle.name, c._registry.paramstyle.name), ('dollar', 'format'))
+        state = State()
+        state.paramstyle = registry.paramstyle
+        c((T.a.b == 1) & (T.a.c == Value('50%')) & E('d = %s', 2), state)
+        self.assertEqual(''.join(state.sql), '"a"."b" = $1 AND "a"."c" = \'50%\' AND (d = $2)')
+        self.assertEqual(c(Name('50%')), ('"50%%"', []))
+        c.paramstyle = 'dollar'
+
+        # Cached fragments with params are not reused with numbered placeholders,
+        # templates of rows are renumbered by position of row.
+        alias = (T.a.b + 5).as_('c')
+        self.assertEqual(c(Q(T.a).fields(T.a.id, alias).where(T.a.id == 1)), (
+            'SELECT "a"."id", ("a"."b" + $1) AS "c" FROM "a" WHERE "a"."id" = $2', [5, 1]
+        ))
+        self.assertEqual(c(Q(T.a).fields(alias).where(T.a.id == 1)), (
+            'SELECT ("a"."b" + $1) AS "c" FROM "a" WHERE "a"."id" = $2', [5, 1]
+        ))
+        self.assertEqual(c(Insert(T.a, fields=('b', 'c'), values=[(1, 2), (3, None)])), (
+            'INSERT INTO "a" ("b", "c") VALUES ($1, $2), ($3, NULL)', [1, 2, 3]
+        ))
+        self.assertEqual(c(Insert(T.a, columns=OrderedDict([('b', [1, 3]), ('c', [2, 4])]))), (
+            'INSERT INTO "a" ("b", "c") VALUES ($1, $2), ($3, $4)', [1, 2, 3, 4]
+        ))
+        self.assertEqual(list(Insert(T.a, fields=('b', 'c'), values=[(1, 2), (3, 4), (5, 6)]).chunks(c, max_params=4)), [
+            ('INSERT INTO "a" ("b", "c") VALUES ($1, $2), ($3, $4)', [1, 2, 3, 4]),
+            ('INSERT INTO "a" ("b", "c") VALUES ($1, $2)', [5, 6]),
+        ])
+        self.assertEqual(c._registry.row_templates[(False, False)], ('(', ', ', ')'))
+        self.assertEqual(c._registry.row_templates[(False, True)], ('(', ', NULL)'))
+        rows = [(i, None if i % 2 else 'x') for i in range(6)]
+        self.assertEqual(c(Insert(T.a, fields=('b', 'c'), values=rows)), (
+            'INSERT INTO "a" ("b", "c") VALUES ($1, $2), ($3, NULL), ($4, $5), ($6, NULL), ($7, $8), ($9, NULL)',
+            [0, 'x', 1, 2, 'x', 3, 4, 'x', 5]
+        ))
+        self.assertEqual(c(Insert(T.a, columns=OrderedDict([('b', list(range(10))), ('c', list(range(10)))])))[0],
+                         'INSERT INTO "a" ("b", "c") VALUES ' + ', '.join(
+                             '(${0}, ${1})'.format(i * 2 + 1, i * 2 + 2) for i in range(10)))
+        self.assertRaises(Error, c, E('a = %s', 1, 2))
+
+        # Raw SQL with params is written in "format" paramstyle, placeholders and escaped percent signs are converted.
+        raw = E("a LIKE '10%%' AND b = %s AND c = %s", 1, 2)
+        self.assertEqual(c(raw), ("a LIKE '10%' AND b = $1 AND c = $2", [1, 2]))
+        self.assertEqual(c(Q().raw("SELECT '%%', %s", [1])), ("SELECT '%', $1", [1]))
+        self.assertEqual(sqlite_compile(raw), ("a LIKE '10%' AND b = ? AND c = ?", [1, 2]))
+        self.assertEqual(sqlite_compile(E('x = %s', 1)), ('x = ?', [1]))
+        self.assertEqual(compile(raw), ("a LIKE '10%%' AND b = %s AND c = %s", [1, 2]))
+        self.assertRaises(Error, sqlite_compile, E('x = %s', 1, 2))
+        import sqlite3
+        self.assertEqual(sqlite3.connect(':memory:').execute(*sqlite_compile(Q().raw("SELECT '10%%', %s", [5]))).fetchall(),
+                         [('10%', 5)])
+
+        # Raw SQL without params is passed as is.
+        raw = Q(T.a).fields(E("strftime('%s', d)"))
+        self.assertEqual(sqlite_compile(raw), ("SELECT (strftime('%s', d)) FROM `a`", []))
+        self.assertEqual(c(E("a LIKE '10%%'")), ("a LIKE '10%%'", []))
+        self.assertEqual(sqlite3.connect(':memory:').execute(*sqlite_compile(
+            Q().raw("SELECT strftime('%s', '1970-01-02')")
+        )).fetchall(), [('86400',)])
+
+        prepared = PreparedQuery(Q(T.a).fields('*').where((T.a.b == P(name='b')) & (T.a.c == 1)), c)
+        self.assertEqual(prepared(b=2), ('SELECT * FROM "a" WHERE "a"."b" = $1 AND "a"."c" = $2', [2, 1]))
+        c.paramstyle = 'named'
+        prepared = PreparedQuery(Q(T.a).fields('*').where(T.a.b == P(name='b')), c)
+        self.assertEqual(prepared(b=2), ('SELECT * FROM "a" WHERE "a"."b" = :p1', {'p1': 2}))
+
+        # Numbering continues between parts, passed to writer.
+        class Writer(list):
+            write = list.append
+
+        n = State.buffer_size + 1
+        writer = Writer()
+        params = c.write(Insert(T.a, fields=('b',), values=iter([(i,) for i in range(n)])), writer)
+        self.assertGreater(len(writer), 1)
+        self.assertTrue(''.join(writer).endswith('(:p{0}), (:p{1})'.format(n - 1, n)))
+        self.assertEqual(params, dict(('p{0}'.format(i + 1), i) for i in range(n)))
+
+
+class TestTemplateCache(TestCase):
+
+    def test_select(self):
+        cache = compile.create_child().template_cache
+
+        def make_query(author_id, status, limit):
+            return Q().fields(T.book.id).tables(
+                (T.book & T.author).on((T.book.author_id == T.author.id) & (T.author.id == author_id))
+            ).where(T.author.status == status).limit(limit)
+
+        self.assertEqual(
+            cache(make_query(1000, 'active', 10)),
+            ('SELECT "book"."id" FROM "book" INNER JOIN "author" ON ("book"."author_id" = "author"."id" AND "author"."id" = %s) WHERE "author"."status" = %s LIMIT %s', [1000, 'active', 10])
+        )
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(cache(make_query(1001, 'draft', 20)), compile(make_query(1001, 'draft', 20)))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache(make_query(5, 'draft', 5)), compile(make_query(5, 'draft', 5)))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        q = make_query(1000, 'active', 10).where(T.author.name.startswith('John'))
+        self.assertEqual(cache(q), compile(q))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        q = make_query(1000, 'active', 10).where(T.author.name.startswith('John')).order_by(T.book.title)
+        self.assertEqual(cache(q), compile(q))
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+    def test_modify(self):
+        cache = compile.create_child().template_cache
+        for i in range(2):
+            q = Q(T.author).fields(T.author.first_name, T.author.age)
+            self.assertEqual(cache(Insert(T.author, fields=q.fields(), values=((i + 1000, 'a'), (i + 2000, 'b')))), (
+                'INSERT INTO "author" ("author"."first_name", "author"."age") VALUES (%s, %s), (%s, %s)', [i + 1000, 'a', i + 2000, 'b']
+            ))
+            self.assertEqual(cache(Update(T.author, map=OrderedDict(((T.author.age, i + 1000),)), where=T.author.id == 'x{0}'.format(i))), (
+                'UPDATE "author" SET "author"."age" = %s WHERE "author"."id" = %s', [i + 1000, 'x{0}'.format(i)]
+            ))
+            self.assertEqual(cache(Delete(T.author, where=T.author.id == i + 1000)), (
+                'DELETE FROM "author" WHERE "author"."id" = %s', [i + 1000]
+            ))
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+    def test_structure(self):
+        cache = compile.create_child().template_cache
+        self.assertEqual(cache(T.author.name == 'John'), ('"author"."name" = %s', ['John']))
+        self.assertEqual(cache(T.book.name == 'John'), ('"book"."name" = %s', ['John']))
+        self.assertEqual(cache(T.author.name == None), ('"author"."name" IS NULL', []))
+        self.assertEqual(cache(T.author.name.in_([1000, 1001])), ('"author"."name" IN (%s, %s)', [1000, 1001]))
+        self.assertEqual(cache(T.author.name.in_([1000, 1001, 1002])), ('"author"."name" IN (%s, %s, %s)', [1000, 1001, 1002]))
+        self.assertEqual(cache(Q(T.author).fields('*').limit(5, 10)), ('SELECT * FROM "author" LIMIT %s OFFSET %s', [10, 5]))
+        self.assertEqual(cache(Q(T.author).fields('*').limit(0, 10)), ('SELECT * FROM "author" LIMIT %s', [10]))
+        self.assertEqual((cache.hits, cache.misses), (0, 7))
+
+    def test_ambiguous(self):
+        cache = compile.create_child().template_cache
+
+        def make_query(first_name, last_name):
+            return Q(T.author).fields('*').where((T.author.first_name == first_name) | (T.author.last_name == last_name))
+
+        # The same object in several leaves, the template is cached only for the same values.
+        for value in ('ambiguous value', 'ambiguous value', 'other value', 'other value'):
+            q = make_query(value, value)
+            self.assertEqual(cache(q), compile(q))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        for first_name, last_name in (('a', 'b'), ('c', 'd')):
+            q = make_query(first_name, last_name)
+            self.assertEqual(cache(q), compile(q))
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+        for i in (1, 1, 2):
+            q = Q(T.author).fields('*').where(T.author.id.in_([i, i, 3])).limit(i)
+            self.assertEqual(cache(q), compile(q))
+        self.assertEqual((cache.hits, cache.misses), (4, 5))
+        for name in ('x', 'y', 'x'):
+            self.assertEqual(cache(T.author.f(name) == name), ('"author"."{0}" = %s'.format(name), [name]))
+        self.assertEqual((cache.hits, cache.misses), (5, 7))
+
+    def test_immutable(self):
+        from sqlbuilder.smartsql import TemplateCache
+        child = compile.create_child()
+        cache = child.template_cache
+        field = T.author.name
+        self.assertEqual(cache(field == 'a'), ('"author"."name" = %s', ['a']))
+        self.assertIn((id(child), TemplateCache), field.__cached__)
+        # Field of subquery refers to mutable nodes, so its structure is not memoized.
+        subquery = Q(T.book).fields(T.book.id).where(T.book.x == 1)
+        field = subquery.as_table('s').id
+        q = Q(T.author).fields(field)
+        self.assertEqual(cache(q), compile(q))
+        self.assertNotIn((id(child), TemplateCache), field.__cached__)
+        subquery._fields.append(T.book.name)
+        self.assertEqual(cache(q), compile(q))
+
+    def test_invalidation(self):
+        child = compile.create_child()
+        self.assertEqual(child.template_cache(T.author.age == 1000), ('"author"."age" = %s', [1000]))
+
+        @child.when(Field)
+        def compile_field(compile, expr, state):
+            compile(expr._name, state)
+
+        self.assertEqual(child.template_cache(T.author.age == 1000), ('"age" = %s', [1000]))
+        self.assertEqual(mysql_compile.template_cache(T.author.age == 1000), ('`author`.`age` = %s', [1000]))
+
+        # SQL, rendered by old handlers during the change of registry, is not stored for new handlers.
+        cache = child.template_cache
+
+        @child.when(Field)
+        def compile_old_field(compile, expr, state):
+            compile.when(Field)(compile_new_field)
+            state.sql.append('old')
+
+        def compile_new_field(compile, expr, state):
+            state.sql.append('new')
+
+        self.assertEqual(cache(T.author.age == 1000), ('old = %s', [1000]))
+        self.assertEqual(cache(T.author.age == 1000), ('new = %s', [1000]))
+        self.assertEqual(cache(T.author.age == 1000), ('new = %s', [1000]))
+        self.assertEqual(len(cache), 1)
+
+    def test_maxsize(self):
+        cache = compile.create_child().template_cache
+        cache.maxsize = 2
+        for name in ('a', 'b', 'c', 'a'):
+            self.assertEqual(cache(T.author.f(name) == 1000), ('"author"."{0}" = %s'.format(name), [1000]))
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+        self.assertEqual(len(cache), 2)
+
+
+class TestPreparedQuery(TestCase):
+
+    def test_select(self):
+        prepared = Q(T.author).fields('*').where(
+            (T.author.status == P(name='status')) & (T.author.age > 18) & (T.author.city == P(name='status'))
+        ).limit(P(name='limit')).prepare()
+        self.assertEqual(prepared.names, ('status', 'limit'))
+        self.assertEqual(
+            prepared(status='active', limit=10),
+            ('SELECT * FROM "author" WHERE "author"."status" = %s AND "author"."age" > %s AND "author"."city" = %s LIMIT %s', ['active', 18, 'active', 10])
+        )
+        self.assertEqual(
+            prepared(limit=5, status='new'),
+            ('SELECT * FROM "author" WHERE "author"."status" = %s AND "author"."age" > %s AND "author"."city" = %s LIMIT %s', ['new', 18, 'new', 5])
+        )
+        self.assertRaises(Error, prepared, status='new')
+        self.assertRaises(TypeError, prepared, status='new', limit=5, unknown=1)
+
+    def test_dialect(self):
+        prepared = Q(T.author, result=Result(compile=mysql_compile)).fields('*').where(T.author.id == P(name='id')).prepare()
+        self.assertEqual(prepared(id=5), ('SELECT * FROM `author` WHERE `author`.`id` = %s', [5]))
+
+    def test_modify(self):
+        prepared = Insert(T.author, fields=('name', 'age'), values=((P(name='name'), P(name='age')),)).prepare()
+        self.assertEqual(prepared(name='John', age=30), ('INSERT INTO "author" ("name", "age") VALUES (%s, %s)', ['John', 30]))
+        prepared = Update(T.author, map=OrderedDict((('age', P(name='age')),)), where=T.author.id == P(name='id')).prepare()
+        self.assertEqual(prepared(id=5, age=30), ('UPDATE "author" SET "age" = %s WHERE "author"."id" = %s', [30, 5]))
+        prepared = Delete(T.author, where=T.author.id == P(name='id')).prepare(mysql_compile)
+        self.assertEqual(prepared(id=5), ('DELETE FROM `author` WHERE `author`.`id` = %s', [5]))
+        self.assertRaises(Error, Delete(T.author, where=T.author.id == P()).prepare)
+
+
+class TestInsertChunks(TestCase):
+
+    def test_chunks(self):
+        rows = [('name{0}'.format(i), i) for i in range(5)]
+        chunks = list(Insert(T.author, fields=('name', 'age'), values=iter(rows)).chunks(max_params=4))
+        self.assertEqual(chunks, [
+            ('INSERT INTO "author" ("name", "age") VALUES (%s, %s), (%s, %s)', ['name0', 0, 'name1', 1]),
+            ('INSERT INTO "author" ("name", "age") VALUES (%s, %s), (%s, %s)', ['name2', 2, 'name3', 3]),
+            ('INSERT INTO "author" ("name", "age") VALUES (%s, %s)', ['name4', 4]),
+        ])
+        self.assertIs(chunks[0][0], chunks[1][0])
+
+        chunks = list(Q(T.author).fields(T.author.name, T.author.age).insert_chunks(
+            rows[:3], max_params=5, on_duplicate_key_update=OrderedDict(((T.author.age, 0),))
+        ))
+        self.assertEqual(chunks, [
+            ('INSERT INTO "author" ("author"."name", "author"."age") VALUES (%s, %s), (%s, %s) '
+             'ON CONFLICT DO UPDATE SET "author"."age" = %s', ['name0', 0, 'name1', 1, 0]),
+            ('INSERT INTO "author" ("author"."name", "author"."age") VALUES (%s, %s) '
+             'ON CONFLICT DO UPDATE SET "author"."age" = %s', ['name2', 2, 0]),
+        ])
+
+    def test_plain_rows(self):
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        date = datetime.date(2020, 1, 1)
+        rows = [(1, 'a', None), [None, None, None], (2, func.NOW(), date), (3, (1, 2), 1.5), (4, P(name='p'), True)]
+        q = Insert(T.author, fields=('a', 'b', 'c'), values=rows)
+        self.assertEqual(compile(q), (
+            'INSERT INTO "author" ("a", "b", "c") VALUES (%s, %s, NULL), (NULL, NULL, NULL), '
+            '(%s, NOW(), %s), (%s, (%s, %s), %s), (%s, %s, %s)', [1, 'a', 2, date, 3, 1, 2, 1.5, 4, rows[-1][1], True]
+        ))
+        self.assertEqual(sqlite_compile(q)[0], (
+            'INSERT INTO `author` (`a`, `b`, `c`) VALUES (?, ?, NULL), (NULL, NULL, NULL), '
+            '(?, NOW(), ?), (?, (?, ?), ?), (?, ?, ?)'
+        ))
+        self.assertTrue(compile.is_plain(datetime.date))
+        self.assertFalse(compile.is_plain(type(None)))
+        self.assertFalse(compile.is_plain(tuple))
+
+    def test_columns(self):
+        import array
+        rating = array.array('d', [0.5, 1.5, 2.5])
+        if sys.version_info >= (3,):
+            rating = memoryview(rating)  # array.array doesn't support new buffer protocol in Python 2.*
+        columns = OrderedDict((
+            ('id', array.array('l', [1, 2, 3])),
+            ('rating', rating),
+            ('name', ['a', 'b', 'c']),
+        ))
+        expected = ('INSERT INTO "author" ("id", "rating", "name") VALUES (%s, %s, %s), (%s, %s, %s), (%s, %s, %s)',
+                    [1, 0.5, 'a', 2, 1.5, 'b', 3, 2.5, 'c'])
+        self.assertEqual(compile(Insert(T.author, columns=columns)), expected)
+        self.assertEqual(Q(T.author).insert(columns=columns), expected)
+
+        columns['name'][1] = None
+        self.assertEqual(compile(Insert(T.author, columns=columns)), (
+            'INSERT INTO "author" ("id", "rating", "name") VALUES (%s, %s, %s), (%s, %s, NULL), (%s, %s, %s)',
+            [1, 0.5, 'a', 2, 1.5, 3, 2.5, 'c']
+        ))
+        self.assertEqual(list(Insert(T.author, columns=columns).chunks(max_params=6)), [
+            ('INSERT INTO "author" ("id", "rating", "name") VALUES (%s, %s, %s), (%s, %s, NULL)', [1, 0.5, 'a', 2, 1.5]),
+            ('INSERT INTO "author" ("id", "rating", "name") VALUES (%s, %s, %s)', [3, 2.5, 'c']),
+        ])
+        self.assertRaises(Error, Insert, T.author, columns={'id': [1, 2], 'name': ['a']})
+
+        class Writer(list):
+            write = list.append
+
+        n = State.buffer_size * 2 + 1
+        q = Insert(T.author, columns=OrderedDict((('id', range(n)), ('name', ['a'] * n))))
+        writer = Writer()
+        params = compile.write(q, writer)
+        self.assertEqual((''.join(writer), params), compile(q))
+        self.assertEqual(len(writer), 3)
+
+        class Buffer(object):
+            # Buffer, which records slices, which are read from it.
+            def __init__(self, values):
+                self.values, self.slices = values, []
+
+            def __len__(self):
+                return len(self.values)
+
+            def __getitem__(self, key):
+                self.slices.append((key.start, key.stop))
+                return array.array('l', self.values[key])
+
+        column = Buffer(list(range(n)))
+        q = Insert(T.author, columns=OrderedDict((('id', column), ('name', ['a'] * n))))
+        self.assertEqual(compile(q), compile(Insert(T.author, columns=OrderedDict((('id', range(n)), ('name', ['a'] * n))))))
+        self.assertEqual(column.slices, [(i, i + State.buffer_size) for i in range(0, n, State.buffer_size)])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy(self):
+        columns = OrderedDict((('id', numpy.arange(3)), ('rating', numpy.array([0.5, 1.5, 2.5]))))
+        sql, params = compile(Insert(T.author, columns=columns))
+        self.assertEqual(sql, 'INSERT INTO "author" ("id", "rating") VALUES (%s, %s), (%s, %s), (%s, %s)')
+        self.assertEqual(params, [0, 0.5, 1, 1.5, 2, 2.5])
+        self.assertEqual([type(i) for i in params[:2]], [int, float])
+
+    def test_not_plain(self):
+        rows = [('name0', func.NOW()), ('name1', 1), ('name2', (1, 2)), ('name3', 3)]
+        chunks = list(Insert(T.author, fields=('name', 'age'), values=rows).chunks(max_params=4))
+        self.assertEqual(chunks, [
+            ('INSERT INTO "author" ("name", "age") VALUES (%s, NOW()), (%s, %s)', ['name0', 'name1', 1]),
+            ('INSERT INTO "author" ("name", "age") VALUES (%s, (%s, %s))', ['name2', 1, 2]),
+            ('INSERT INTO "author" ("name", "age") VALUES (%s, %s)', ['name3', 3]),
+        ])
+        q = Insert(T.author, fields=('name', 'age'), values=Q(T.old_author).fields(T.old_author.name, T.old_author.age))
+        self.assertEqual(list(q.chunks(max_params=1)), [compile(q)])
+
+    def test_dialect(self):
+        import sqlite3
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        self.assertIn(sqlite_compile.max_params, (999, 32766))
+        self.assertEqual(sqlite_compile.create_child().max_params, sqlite_compile.max_params)
+
+        n = sqlite_compile.max_params + 1
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE author (name TEXT, age INTEGER)')
+        chunks = list(Insert(T.author, fields=('name', 'age'), values=(('name', i) for i in range(n))).chunks(sqlite_compile))
+        self.assertEqual(len(chunks), 3)
+        for sql, params in chunks:
+            connection.execute(sql, params)
+        self.assertEqual(connection.execute('SELECT COUNT(*), SUM(age) FROM author').fetchone(), (n, n * (n - 1) // 2))
+
+        self.assertEqual(list(Insert(T.author, fields=('name', 'age'), values=[('John', 30)], ignore=True).chunks(mysql_compile)), [
+            ('INSERT IGNORE INTO `author` (`name`, `age`) VALUES (%s, %s)', ['John', 30])
+        ])
+
+
+class TestCopy(TestCase):
+
+    def test_copy(self):
+        from sqlbuilder.smartsql import Copy
+        self.assertEqual(compile(Copy(T.author, fields=('name', T.author.age))), (
+            'COPY "author" ("name", "age") FROM STDIN', []
+        ))
+        self.assertEqual(compile(Copy(T.author, fields=('name',), format='CSV', delimiter=';', null="'", header=True)), (
+            'COPY "author" ("name") FROM STDIN WITH (FORMAT csv, DELIMITER \';\', NULL \'\'\'\', HEADER true)', []
+        ))
+        self.assertRaises(Error, compile, Copy(T.author, format='xml'))
+
+    def test_text(self):
+        from sqlbuilder.smartsql import Copy
+        import io
+        rows = [
+            (1, u'a\tb\\c\nd', None, True, 1.5),  # str of Python 2.* is binary, like bytes
+            (2, u'', b'\x01\xff', False, float('nan')),
+            (3, datetime.date(2020, 1, 2), datetime.datetime(2020, 1, 2, 3, 4, 5), None, float('-inf')),
+        ]
+        file = io.StringIO()
+        Copy(T.author).encoder().write(rows, file)
+        self.assertEqual(file.getvalue(), (
+            '1\ta\\\tb\\\\c\\nd\t\\N\tt\t1.5\n'
+            '2\t\t\\\\x01ff\tf\tNaN\n'
+            '3\t2020-01-02\t2020-01-02T03:04:05\t\\N\t-Infinity\n'
+        ))
+
+    def test_csv(self):
+        from sqlbuilder.smartsql import Copy, CopyEncoder
+        import csv
+        import io
+        rows = [(1, u'a,"b"'), (2, u''), (3, None), (4, u'\\.'), (5, u'x\ny')]
+        encoder = Copy(T.author, fields=('id', 'name'), format='csv', header=True).encoder()
+        data = ''.join(encoder.iterencode(rows))
+        self.assertEqual(data, 'id,name\n1,"a,""b"""\n2,""\n3,\n4,"\\."\n5,"x\ny"\n')
+        self.assertEqual(list(csv.reader(io.StringIO(data)))[1:], [[str(i), v or ''] for i, v in rows])
+
+        encoder = CopyEncoder('csv', quote="'", escape='\\')
+        self.assertEqual(encoder.encode_row([u"it's", u'a\\b']), "'it\\'s','a\\\\b'\n")
+
+        encoder = CopyEncoder()
+        encoder.chunk_size = 100
+        chunks = list(encoder.iterencode((i, u'name') for i in range(1000)))
+        self.assertGreater(len(chunks), 10)
+        self.assertTrue(all(len(chunk) < 200 for chunk in chunks))
+        self.assertEqual(''.join(chunks), ''.join('{0}\tname\n'.format(i) for i in range(1000)))
+        self.assertRaises(Error, CopyEncoder, 'binary')
+
+
+class TestCachedResult(TestCase):
+
+    def setUp(self):
+        import sqlite3
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        connection = sqlite3.connect(':memory:')
+        connection.execute('CREATE TABLE author (id INTEGER PRIMARY KEY, name TEXT)')
+        connection.execute('CREATE TABLE book (id INTEGER PRIMARY KEY, title TEXT, author_id INTEGER)')
+        self.executed = executed = []
+
+        class SQLiteResult(Result):
+
+            def execute(self):
+                sql, params = self.compile(self._query)
+                executed.append(sql)
+                return connection.execute(sql, params)
+
+            def select(self):
+                return self.execute().fetchall()
+
+            def count(self):
+                return self.execute().fetchone()[0]
+
+            def insert(self):
+                return self.execute().rowcount
+
+            update = delete = insert
+
+            def __iter__(self):
+                return iter(self.select())
+
+        self.result = SQLiteResult(compile=sqlite_compile)
+
+    def test_result(self):
+        from sqlbuilder.smartsql.cache import CachedResult
+        result = CachedResult(self.result)
+        a, b = T.author, T.book
+        q = Q(a, result=result).fields(a.id, a.name)
+        q.insert({'name': 'John'})
+        self.assertEqual(q.select(), [(1, 'John')])
+        self.assertEqual(q.select(), [(1, 'John')])
+        self.assertEqual(list(q), [(1, 'John')])
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.count(), 1)
+        self.assertEqual(q.count(), 1)
+        self.assertEqual(len(self.executed), 4)  # insert, select, iteration and count
+
+        # Changes of other tables don't invalidate entries.
+        books = Q(b, result=result).fields(b.id, b.author_id)
+        books.insert({'title': 'Title', 'author_id': 1})
+        self.assertEqual(q.select(), [(1, 'John')])
+        self.assertEqual(len(self.executed), 5)
+
+        # Joins and subqueries depend on all their tables.
+        joined = Q((b & a).on(b.author_id == a.id), result=result).fields(b.title, a.name)
+        subquery = Q(a, result=result).fields(a.name).where(a.id.in_(Q(b).fields(b.author_id)))
+        self.assertEqual(joined.select(), [('Title', 'John')])
+        self.assertEqual(subquery.select(), [('John',)])
+        self.assertEqual(len(self.executed), 7)
+        books.where(b.id == 1).update({'title': 'New title'})
+        self.assertEqual(q.select(), [(1, 'John')])
+        self.assertEqual(joined.select(), [('New title', 'John')])
+        self.assertEqual(subquery.select(), [('John',)])
+        self.assertEqual(len(self.executed), 10)
+
+        q.where(a.id == 1).update({'name': 'Tom'})
+        self.assertEqual(q.select(), [(1, 'Tom')])
+        self.assertEqual(q.count(), 1)
+        q.delete()
+        self.assertEqual(q.select(), [])
+        self.assertEqual(q.count(), 0)
+
+        # Invalidation by hand, e.g. after raw SQL.
+        self.assertEqual(len(self.executed), 16)
+        self.assertEqual(joined.select(), [])
+        self.assertEqual(joined.select(), [])
+        result.invalidate(b)
+        self.assertEqual(joined.select(), [])
+        self.assertEqual(len(self.executed), 18)
+
+    def test_get_tables(self):
+        from sqlbuilder.smartsql.cache import get_tables, get_modified_tables
+        a, b = T.author, T.book
+        ab = b.as_('ab')
+        self.assertEqual(get_tables(Q(a).fields('*')), {'author'})
+        self.assertEqual(get_tables(Q((a & ab).on(ab.author_id == a.id)).fields(ab.title)), {'author', 'book'})
+        sub = Q(b).fields(b.author_id).where(b.x == T.review.book_id).as_table('sub')
+        self.assertEqual(get_tables(Q(a).fields(a.id).where(a.id.in_(Q(sub).fields(sub.author_id)))), {'author', 'book', 'review'})
+        self.assertEqual(get_tables(Q(a).fields('*') | Q(b).fields('*')), {'author', 'book'})
+        self.assertEqual(get_modified_tables(Update(a, {'name': 'x'}, where=a.id.in_(Q(b).fields(b.author_id)))), {'author'})
+        self.assertEqual(get_modified_tables(Insert(T.log, fields=('x',), values=Q(a).fields(a.x))), {'log'})
+        self.assertEqual(get_modified_tables(Q(a).fields('*')), set())
+
+    def test_backends(self):
+        import shutil
+        import tempfile
+        from sqlbuilder.smartsql.cache import CachedResult, LocMemCache, FileCache
+        cache = LocMemCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        cache.set('d', 4, timeout=0)
+        self.assertIsNone(cache.get('d'))
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = FileCache(directory, max_entries=2)
+            cache.set('a', [1, 'x'])
+            self.assertEqual(cache.get('a'), [1, 'x'])
+            cache.set('b', 2, timeout=0)
+            self.assertIsNone(cache.get('b'))
+            cache.set('c', 3)
+            cache.set('d', 4)
+            self.assertEqual(len(cache), 2)
+            cache.delete('d')
+            self.assertIsNone(cache.get('d'))
+
+            # Results, which share a backend (e.g. in different processes), invalidate entries of each other.
+            cache.clear()
+            result1, result2 = CachedResult(self.result, FileCache(directory)), CachedResult(self.result, FileCache(directory))
+            Q(T.author, result=result1).insert({'name': 'John'})
+            self.assertEqual(Q(T.author, result=result1).fields(T.author.name).select(), [('John',)])
+            self.assertEqual(Q(T.author, result=result2).fields(T.author.name).select(), [('John',)])
+            Q(T.author, result=result2).update({'name': 'Tom'})
+            self.assertEqual(Q(T.author, result=result1).fields(T.author.name).select(), [('Tom',)])
+            self.assertEqual(len(self.executed), 4)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestPooledResult(TestCase):
+
+    def setUp(self):
+        import os
+        import sqlite3
+        import tempfile
+        from sqlbuilder.smartsql.pool import ConnectionPool, PooledResult
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.pool = ConnectionPool(lambda: sqlite3.connect(self.path, check_same_thread=False), max_size=2, timeout=5)
+        self.result = PooledResult(self.pool, compile=sqlite_compile)
+        with self.pool.connection() as connection:
+            connection.execute('CREATE TABLE author (id INTEGER PRIMARY KEY, name TEXT)')
+
+    def tearDown(self):
+        import os
+        self.pool.close()
+        os.remove(self.path)
+
+    def test_result(self):
+        import sqlite3
+        a = T.author
+        q = Q(a, result=self.result).fields(a.id, a.name)
+        self.assertEqual(q.insert({'name': 'John'}), 1)
+        self.assertEqual(self.result(Insert(a, map={'name': P(name='name')})).executemany(
+            [{'name': 'n{0}'.format(i)} for i in range(5)]
+        ), 5)
+        self.assertEqual(q.count(), 6)
+        self.assertEqual(len(q), 6)
+        self.assertEqual(q.where(a.id < 3).select(), [(1, 'John'), (2, 'n0')])
+        self.assertEqual(list(q.where(a.id == 1)), [(1, 'John')])
+        self.assertEqual(q.where(a.id > 1).update({'name': 'x'}), 5)
+        self.assertEqual(q.where(a.id > 4).delete(), 2)
+
+        # Failed statement is rolled back, the connection is returned to the pool.
+        self.assertRaises(sqlite3.IntegrityError, self.result(Insert(a, map={'id': P(name='id')})).executemany, [{'id': 10}, {'id': 1}])
+        self.assertEqual(q.count(), 4)
+        self.assertEqual(self.pool.in_use, 0)
+        self.assertEqual(self.pool.created, 1)
+
+    def test_pool(self):
+        import threading
+        from sqlbuilder.smartsql.pool import PoolTimeout
+        pool = self.pool
+        pool.reset_stats()
+        c1, c2 = pool.checkout(), pool.checkout()
+        self.assertEqual((pool.size, pool.in_use, pool.idle, pool.created), (2, 2, 0, 1))
+        self.assertRaises(PoolTimeout, pool.checkout, 0.01)
+        self.assertEqual((pool.waits, pool.timeouts), (1, 1))
+
+        # Waiting for a returned connection.
+        checked_out = []
+        thread = threading.Thread(target=lambda: checked_out.append(pool.checkout()))
+        thread.start()
+        while pool.waits < 2:
+            thread.join(0.001)
+        pool.checkin(*c1)
+        thread.join()
+        self.assertIs(checked_out[0][0], c1[0])
+        pool.checkin(*checked_out[0])
+        pool.checkin(*c2)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        self.assertEqual(pool.stats()['idle'], 2)
+
+        # Broken connections are replaced.
+        pool.health_check = lambda connection: connection is not c2[0]
+        connection, created = pool.checkout()
+        self.assertIsNot(connection, c2[0])
+        self.assertEqual((pool.created, pool.closed), (2, 1))
+        pool.checkin(connection, created)
+
+        # Old connections are recycled.
+        pool.max_lifetime = 0
+        connection, created = pool.checkout()
+        pool.checkin(connection, created)
+        self.assertEqual((pool.created, pool.closed, pool.size), (3, 3, 1))
+
+    def test_threads(self):
+        pool, errors = self.pool, []
+        pool.reset_stats()
+        q = Q(T.author, result=self.result).fields(T.author.id)
+
+        def run():
+            try:
+                for i in range(200):
+                    q.insert({'name': 'n{0}'.format(i)})
+                    q.count()
+            except Exception as e:
+                errors.append(e)
+
+        import threading
+        threads = [threading.Thread(target=run) for i in range(8)]
+        switch_interval = sys.getswitchinterval() if hasattr(sys, 'getswitchinterval') else None
+        if switch_interval is not None:
+            sys.setswitchinterval(1e-6)  # Switch threads as often as possible to expose races.
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if switch_interval is not None:
+                sys.setswitchinterval(switch_interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(q.count(), 1600)
+        self.assertLessEqual(pool.created, 2)
+        self.assertEqual(pool.in_use, 0)
+
+
+@unittest.skipIf(aio is None, "Python 3.6+ is required")
+class TestAsyncResult(TestCase):
+
+    def setUp(self):
+        import asyncio
+        from sqlbuilder.smartsql.dialects.sqlite import compile as sqlite_compile
+        self.loop = asyncio.new_event_loop()
+        self.driver = aio.SQLiteDriver(':memory:')
+        self.result = aio.AsyncResult(self.driver, compile=sqlite_compile)
+        self.run_async(self.driver.execute('CREATE TABLE author (id INTEGER PRIMARY KEY, name TEXT)', ()))
+
+    def tearDown(self):
+        self.run_async(self.driver.close())
+        self.loop.close()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def fetch_all(self, iterator):
+        rows = []
+        while True:
+            try:
+                rows.append(self.run_async(iterator.__anext__()))
+            except StopAsyncIteration:
+                return rows
+
+    def test_result(self):
+        q = Q(T.author, result=self.result).fields(T.author.id, T.author.name)
+        self.assertEqual(self.run_async(Q(T.author, result=self.result).insert({'name': 'John'})), 1)
+        self.assertEqual(self.run_async(
+            self.result(Insert(T.author, fields=('name',), values=[('n{0}'.format(i),) for i in range(10)])).insert()
+        ), 10)
+        self.assertEqual(self.run_async(q.count()), 11)
+        self.assertEqual(self.run_async(q.where(T.author.id < 3).select()), [(1, 'John'), (2, 'n0')])
+        self.assertEqual(self.run_async(q.where(T.author.id > 1).update({'name': 'x'})), 10)
+        self.assertEqual(self.fetch_all(q.iterate(chunk_size=3)), [(1, 'John')] + [(i, 'x') for i in range(2, 12)])
+        self.assertEqual(len(self.fetch_all(q.__aiter__())), 11)
+        self.assertEqual(self.run_async(q.where(T.author.id > 1).delete()), 10)
+        self.assertRaises(Error, list, q)
+        self.assertRaises(Error, len, q)
+
+    def test_timeout(self):
+        import asyncio
+        slow = Q(result=self.result).raw(
+            "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 1000000000) SELECT COUNT(*) FROM c", ()
+        )
+        self.assertIsNone(slow.result.timeout)
+        self.assertRaises(asyncio.TimeoutError, self.run_async, slow.with_timeout(0.05).select())
+        self.assertIsNone(slow.result.timeout)
+
+        # The query is interrupted, so the connection is available for next one.
+        task = self.loop.create_task(slow.select())
+        self.run_async(asyncio.sleep(0.05))
+        task.cancel()
+        self.assertRaises(asyncio.CancelledError, self.run_async, task)
+        self.assertEqual(self.run_async(asyncio.wait_for(Q(T.author, result=self.result).fields('*').count(), 5)), 0)
+
+
 class TestSmartSQLLegacy(TestCase):
 
     def test_prefix(self):